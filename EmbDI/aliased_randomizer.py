@@ -43,6 +43,8 @@ SOFTWARE.
 
 import random
 
+import numpy as np
+
 def prepare_aliased_randomizer(neighbor_names, weights):
     '''Implemented according to the alias method.
 
@@ -77,3 +79,86 @@ def prepare_aliased_randomizer(neighbor_names, weights):
         # return alias if (r - i) > odds else i
 
     return weighted_random
+
+
+def prepare_alias_tables(indptr, weights):
+    '''Build the alias tables of all the nodes of a graph at once, with the same pairing of small and big
+    neighbors as prepare_aliased_randomizer. The neighbors of node n are the slots indptr[n]:indptr[n+1] of weights.
+
+    In every node, the deficits (1 - odds) of the small neighbors and the excesses (odds - 1) of the big neighbors are
+    laid out in two prefix sums: a small neighbor is aliased to the first big neighbor whose cumulative excess covers
+    the deficits before it, and a big neighbor drops below 1 when the deficits pass its cumulative excess. The prefix
+    sums run over the whole graph, so that a single search pairs the neighbors of every node.
+
+    :param indptr: array of offsets of the neighbors of each node
+    :param weights: array with the weights of the neighbors
+    :return: odds, alias: arrays with the probability of keeping each slot and the slot drawn otherwise
+    '''
+    indptr = np.asarray(indptr, dtype=np.int64)
+    weights = np.asarray(weights, dtype=np.float64)
+    degrees = np.diff(indptr)
+    if (degrees == 0).any():
+        raise ValueError('Node has no neighbors. Check the input dataset.')
+    odds = np.ones(len(weights))
+    alias = np.arange(len(weights))
+    if len(weights) == 0:
+        return odds, alias
+
+    node = np.repeat(np.arange(len(degrees)), degrees)
+    avg = (np.add.reduceat(weights, indptr[:-1]) / degrees)[node]
+    q = weights / avg
+    is_small = weights < avg
+    D = np.cumsum(np.where(is_small, 1 - q, 0))
+    E = np.cumsum(np.where(is_small, 0, q - 1))
+    D_before = np.append(0, D)[:-1]
+    D_base = np.append(0, D)[indptr[:-1]][node]
+    E_base = np.append(0, E)[indptr[:-1]][node]
+    smalls = np.flatnonzero(is_small)
+    bigs = np.flatnonzero(~is_small)
+    first_small, end_small = np.searchsorted(smalls, indptr[:-1]), np.searchsorted(smalls, indptr[1:])
+    first_big, end_big = np.searchsorted(bigs, indptr[:-1]), np.searchsorted(bigs, indptr[1:])
+
+    def covering_big(deficits):
+        # Position in bigs of the first big neighbor of the node whose cumulative excess covers the deficits, or the
+        # end of the bigs of the node if there is none.
+        n = node[smalls]
+        j = np.searchsorted(E[bigs], deficits - D_base[smalls] + E_base[smalls], side='left')
+        return np.clip(j, first_big[n], end_big[n])
+
+    # Each small neighbor is aliased to the big neighbor that covers the deficits before it. The same search with the
+    # deficits up to the small neighbor gives the big neighbor that covers the next one, so the big neighbors that
+    # drop below 1 are consistent with the pairing.
+    j = covering_big(D_before[smalls])
+    j_next = covering_big(D[smalls])
+    paired = j < end_big[node[smalls]]
+    odds[smalls[paired]] = q[smalls[paired]]
+    alias[smalls[paired]] = bigs[j[paired]]
+
+    # A big neighbor drops below 1 at the first small neighbor after which the deficits pass its excess, and is
+    # aliased to the next big neighbor of the node, if there is one.
+    position = np.arange(len(bigs))
+    n = node[bigs]
+    k = np.maximum(np.searchsorted(j_next, position, side='right'), first_small[n])
+    dropped = (k < end_small[n]) & (position + 1 < end_big[n])
+    drop_at = smalls[k[dropped]]
+    big = bigs[dropped]
+    odds[big] = 1 + (E[big] - E_base[big]) - (D[drop_at] - D_base[drop_at])
+    alias[big] = bigs[position[dropped] + 1]
+    return odds, alias
+
+
+def alias_draws(indptr, odds, alias, nodes, rng=np.random):
+    '''Draw a weighted random neighbor for each of the given nodes from the tables of prepare_alias_tables.
+
+    :param indptr: array of offsets of the neighbors of each node
+    :param odds: odds returned by prepare_alias_tables
+    :param alias: alias returned by prepare_alias_tables
+    :param nodes: array of nodes
+    :param rng: source of the random numbers, either numpy.random or a numpy Generator
+    :return: array with the slot of the drawn neighbor of each node
+    '''
+    lo = indptr[nodes]
+    r = rng.random(len(nodes)) * (indptr[nodes + 1] - lo)
+    i = r.astype(np.int64)
+    slots = lo + i
+    return np.where((r - i) > odds[slots], alias[slots], slots)
@@ -0,0 +1,323 @@
+import random
+from array import array
+
+import numpy as np
+
+from EmbDI.aliased_randomizer import prepare_alias_tables, alias_draws
+from EmbDI.edgelist import EdgeTable
+
+# Bits of the node class, see Node._extract_class
+ISFIRST = 4
+ISROOT = 2
+ISAPPEAR = 1
+
+
+class CSRGraph:
+    """
+        Graph that stores its adjacency as integer CSR arrays instead of one Node object per token. The neighbors of
+        node i are indices[indptr[i]:indptr[i+1]] with the weights weights[indptr[i]:indptr[i+1]], and its name is
+        vocab[i]. The nodes a walk can start from before node i are start_indices[start_indptr[i]:start_indptr[i+1]].
+        Neighbors are drawn from the alias tables odds and alias, built for all nodes by prepare_alias_tables.
+
+        It is built from the same edgelists as Graph and has the same nodes, neighbors, weights and walk starting
+        points, so random walks on both graphs follow the same distribution.
+    """
+
+    def __init__(self, edgelist, prefixes, flatten=[]):
+        """
+        :param edgelist: EdgeTable, or list of edges (n1, n2[, w1[, w2]]) as accepted by Graph
+        :param prefixes: node type prefixes, as in the header of the edgelist file
+        :param flatten: if present and different from "all", expand the strings of all nodes whose type is in the list.
+        """
+        self.node_classes = {}
+        self._extract_prefix(prefixes)
+        if flatten == 'all':
+            self.to_flatten = set(self.node_classes)
+        else:
+            for _ in flatten:
+                if _ not in self.node_classes:
+                    raise ValueError('Unknown to-flatten type {}.'.format(_))
+            self.to_flatten = set(flatten)
+
+        self.types = list(self.node_classes)
+        self._type_codes = {node_prefix: code for code, node_prefix in enumerate(self.types)}
+        self._index = {}
+        self._names = []
+        self._types = array('b')
+        self.uniform = True
+        if isinstance(edgelist, EdgeTable):
+            src, dst, w_forward, w_back = self._read_edge_table(edgelist)
+        else:
+            src, dst, w_forward, w_back = self._read_edgelist(edgelist)
+
+        if len(self._names) == 0:
+            raise ValueError('No nodes found in edgelist!')
+
+        self.vocab = np.array(self._names, dtype=object)
+        self.node_type = np.frombuffer(self._types, dtype=np.int8)
+        self.node_class = np.array([self.node_classes[_] for _ in self.types], dtype=np.int8)[self.node_type]
+        self._build_arrays(src, dst, w_forward, w_back)
+        del self._index, self._names, self._types
+
+        self.n_nodes = len(self.vocab)
+        self.n_edges = len(src)
+        self.isappear = (self.node_class & ISAPPEAR) > 0
+        self.cell_list = np.flatnonzero(self.node_class & ISROOT).tolist()
+
+    def _read_edgelist(self, edgelist):
+        """Read a list of edges (n1, n2[, w1[, w2]]) with the node names as strings, like Graph."""
+        links = {}
+        src, dst = array('l'), array('l')
+        w_forward, w_back = array('d'), array('d')
+
+        for line in edgelist:
+            n1 = line[0]
+            n2 = line[1]
+
+            if n1 is np.nan or n2 is np.nan:
+                raise ValueError('{} or {} are NaNs.'.format(n1, n2))
+
+            if len(line) == 2:
+                w1 = w2 = 1
+            elif len(line) == 4:
+                w1 = line[2]
+                w2 = line[3]
+            elif len(line) == 3:
+                # unidirectional edge
+                w1 = line[2]
+                w2 = None
+            else:
+                raise ValueError('Line {} does not contain the correct number of values'.format(line))
+
+            if w1 != w2 or w2 is None:
+                self.uniform = False
+
+            # Each endpoint is resolved to the nodes it links only the first time it is seen.
+            to_link = []
+            for _n in [n1, n2]:
+                node_name = str(_n)
+                try:
+                    to_link.append(links[node_name])
+                except KeyError:
+                    links[node_name] = self._resolve(node_name, self._get_node_type(node_name))
+                    to_link.append(links[node_name])
+
+            for _1 in to_link[0]:
+                for _2 in to_link[1]:
+                    if _1 != _2:
+                        src.append(_1)
+                        dst.append(_2)
+                        w_forward.append(w1)
+                        w_back.append(np.nan if w2 is None else w2)
+
+        return (np.frombuffer(src, dtype=np.int64), np.frombuffer(dst, dtype=np.int64),
+                np.frombuffer(w_forward), np.frombuffer(w_back))
+
+    def _read_edge_table(self, table):
+        """Read an EdgeTable. Every distinct endpoint is resolved to the nodes it links once, in the order of its first
+        edge, then the edges between the resolved nodes are expanded at once.
+        """
+        types = []
+        for prefix in table.prefixes:
+            node_prefix = prefix.split('__')[1]
+            if node_prefix not in self.node_classes:
+                raise ValueError('Node type {} is not a recognized prefix. '
+                                 'Currently recognized node_classes:\n{}'.format(node_prefix,
+                                                                                   ' '.join(self.node_classes)))
+            types.append(node_prefix)
+
+        # Endpoints in the order in which they first appear in the edges
+        endpoints = np.stack([table.src, table.dst], axis=1).ravel()
+        _, first = np.unique(endpoints, return_index=True)
+        order = endpoints[np.sort(first)]
+        links = [None] * len(table.names)
+        for j in order.tolist():
+            links[j] = self._resolve(table.names[j], types[table.node_type[j]])
+
+        n_links = np.array([len(_) if _ is not None else 0 for _ in links], dtype=np.int64)
+        link_ptr = np.zeros(len(links) + 1, dtype=np.int64)
+        np.cumsum(n_links, out=link_ptr[1:])
+        link_ids = np.fromiter((i for _ in links if _ is not None for i in _), dtype=np.int64, count=link_ptr[-1])
+
+        # Every edge links all the nodes of its first endpoint to all the nodes of its second one.
+        n_src, n_dst = n_links[table.src], n_links[table.dst]
+        counts = n_src * n_dst
+        edge = np.repeat(np.arange(len(table)), counts)
+        k = np.arange(len(edge)) - np.repeat(np.cumsum(counts) - counts, counts)
+        src = link_ids[link_ptr[table.src[edge]] + k // n_dst[edge]]
+        dst = link_ids[link_ptr[table.dst[edge]] + k % n_dst[edge]]
+        keep = src != dst
+
+        if len(table) and ((table.w1 != table.w2) | np.isnan(table.w2)).any():
+            self.uniform = False
+        return src[keep], dst[keep], table.w1[edge][keep], table.w2[edge][keep]
+
+    def _extract_prefix(self, prefixes):
+        valid = False
+        for prefix in prefixes:
+            prefix_properties, pref = prefix.split('__')
+            strnum = prefix_properties[1]
+            rwclass = int(prefix_properties[0])
+            if rwclass not in range(8):
+                raise ValueError('Unknown class {}'.format(rwclass))
+            self.node_classes[pref] = rwclass
+            if rwclass % 2 == 1:
+                valid = True
+            if strnum not in ['#', '$']:
+                raise ValueError('Unknown type prefix {}'.format(strnum))
+        if not valid:
+            raise ValueError('No node class with "isappear"==True is present. '
+                             'All random walks will be empty. Terminating. ')
+
+    def _get_node_type(self, node):
+        for pre in self.node_classes:
+            if node.startswith(pre + '__'):
+                return pre
+        raise ValueError('Node {} does not have a recognized prefix. '
+                         'Currently recognized node_classes:\n{}'.format(node, ' '.join(self.node_classes)))
+
+    def _get_or_add(self, node_name, node_prefix):
+        try:
+            return self._index[node_name]
+        except KeyError:
+            self._index[node_name] = len(self._names)
+            self._names.append(node_name)
+            self._types.append(self._type_codes[node_prefix])
+            return self._index[node_name]
+
+    def _resolve(self, node_name, node_prefix):
+        """Return the ids of the nodes linked by an endpoint of an edge, creating them in the same order as Graph:
+        the node itself and, if its type is flattened, one node for every word of its name.
+        """
+        ids = []
+        if node_prefix in self.to_flatten:
+            for val in node_name.split('_')[1:]:
+                if val != '':
+                    ids.append(self._get_or_add(node_prefix + '__' + val, node_prefix))
+        ids.append(self._get_or_add(node_name, node_prefix))
+        return list(dict.fromkeys(ids))
+
+    def _build_arrays(self, src, dst, w_forward, w_back):
+        """Turn the edges into CSR arrays. Every edge adds the arc src->dst and, if it has a back weight, the arc
+        dst->src. Like Node.add_neighbor, a repeated arc keeps the position of its first occurrence and the weight of
+        its last one, while every arc towards a starting node counts as a walk start, repeated arcs included.
+        """
+        n = len(self.vocab)
+        arc_from = np.stack([src, dst], axis=1).ravel()
+        arc_to = np.stack([dst, src], axis=1).ravel()
+        arc_weight = np.stack([w_forward, w_back], axis=1).ravel()
+        keep = ~np.isnan(arc_weight)
+        arc_from, arc_to, arc_weight = arc_from[keep], arc_to[keep], arc_weight[keep]
+        seq = np.arange(len(arc_from))
+
+        # Group the repeated arcs.
+        order = np.lexsort((seq, arc_to, arc_from))
+        f, t = arc_from[order], arc_to[order]
+        new_group = np.ones(len(f), dtype=bool)
+        new_group[1:] = (f[1:] != f[:-1]) | (t[1:] != t[:-1])
+        first = np.flatnonzero(new_group)
+        last = np.append(first[1:], len(f)) - 1
+        g_from, g_to = f[first], t[first]
+        g_weight = arc_weight[order][last]
+        g_seq = seq[order][first]
+
+        order = np.lexsort((g_seq, g_from))
+        counts = np.bincount(g_from, minlength=n)
+        if (counts == 0).any():
+            raise ValueError('Node {} has no neighbors'.format(self.vocab[np.argmin(counts)]))
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.indptr[1:])
+        self.indices = g_to[order].astype(np.int32)
+        self.weights = g_weight[order]
+
+        is_start = (self.node_class[arc_to] & ISFIRST) > 0
+        start_from = arc_from[is_start]
+        order = np.argsort(start_from, kind='stable')
+        self.start_indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(start_from, minlength=n), out=self.start_indptr[1:])
+        self.start_indices = arc_to[is_start][order].astype(np.int32)
+
+        self.odds, self.alias = prepare_alias_tables(self.indptr, self.weights)
+
+    # Arrays that define the graph, see to_arrays
+    ARRAYS = ['indptr', 'indices', 'weights', 'start_indptr', 'start_indices', 'odds', 'alias', 'node_type']
+
+    def to_arrays(self):
+        """Return the graph as a dictionary of numpy arrays, which can be saved with numpy.savez and loaded with
+        from_arrays.
+        """
+        arrays = {_: getattr(self, _) for _ in self.ARRAYS}
+        arrays['vocab'] = self.vocab.astype(str)
+        arrays['types'] = np.array(self.types)
+        arrays['classes'] = np.array([self.node_classes[_] for _ in self.types], dtype=np.int8)
+        arrays['uniform'] = np.array(self.uniform)
+        arrays['n_edges'] = np.array(self.n_edges)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Create a graph from the arrays returned by to_arrays."""
+        graph = cls.__new__(cls)
+        for _ in cls.ARRAYS:
+            setattr(graph, _, np.asarray(arrays[_]))
+        graph.vocab = np.asarray(arrays['vocab']).astype(object)
+        graph.types = np.asarray(arrays['types']).tolist()
+        graph.node_classes = dict(zip(graph.types, np.asarray(arrays['classes']).tolist()))
+        graph.uniform = bool(arrays['uniform'])
+        graph.node_class = np.asarray(arrays['classes'])[graph.node_type]
+        graph.n_nodes = len(graph.vocab)
+        graph.n_edges = int(arrays['n_edges'])
+        graph.isappear = (graph.node_class & ISAPPEAR) > 0
+        graph.cell_list = np.flatnonzero(graph.node_class & ISROOT).tolist()
+        return graph
+
+    def compute_n_sentences(self, sentence_length, factor=1000):
+        """Compute the default number of sentences according to the rule of thumb:
+        n_sentences = n_nodes * representation_factor // sentence_length
+
+        :param sentence_length: target sentence length
+        :param factor: "desired" number of occurrences of each node
+        :return: n_sentences
+        """
+        return self.n_nodes * factor // sentence_length
+
+    def get_node_list(self):
+        return self.vocab.tolist()
+
+    def produce_intersection(self, intersecting_nodes):
+        """Return the ids of the nodes whose value is in intersecting_nodes, in the order of the graph, like
+        Graph.produce_intersection returns their names.
+        """
+        return [i for i, node in enumerate(self.vocab.tolist()) if node.split('__', 1)[1] in intersecting_nodes]
+
+    def get_graph(self):
+        return self
+
+    def get_random_start(self, node):
+        lo, hi = self.start_indptr[node], self.start_indptr[node + 1]
+        if hi > lo:
+            return int(self.start_indices[lo + int(random.random() * (hi - lo))])
+        else:
+            return node
+
+    def get_weighted_random_neighbor(self, node):
+        lo = self.indptr[node]
+        r = random.random() * (self.indptr[node + 1] - lo)
+        i = int(r)
+        if (r - i) > self.odds[lo + i]:
+            return int(self.indices[self.alias[lo + i]])
+        else:
+            return int(self.indices[lo + i])
+
+    def random_starts(self, nodes, rng=np.random):
+        """Vectorized get_random_start: draw a starting node for each of the given nodes, using rng."""
+        if len(self.start_indices) == 0:
+            return nodes.copy()
+        lo = self.start_indptr[nodes]
+        counts = self.start_indptr[nodes + 1] - lo
+        draws = lo + (rng.random(len(nodes)) * counts).astype(np.int64)
+        return np.where(counts > 0, self.start_indices[np.minimum(draws, len(self.start_indices) - 1)].astype(nodes.dtype), nodes)
+
+    def weighted_random_neighbors(self, nodes, rng=np.random):
+        """Vectorized get_weighted_random_neighbor: draw a neighbor for each of the given nodes, using rng."""
+        return self.indices[alias_draws(self.indptr, self.odds, self.alias, nodes, rng)]
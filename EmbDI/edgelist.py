@@ -15,28 +15,163 @@ limitations under the License.
 """
 
 import argparse
+import itertools
 import math
 import os.path as osp
-import pickle
-from collections import Counter
 
-import networkx as nx
 import numpy as np
 import pandas as pd
+import scipy.sparse
 from tqdm import tqdm
 
 
+class EdgeTable:
+    """
+        Edges of an EdgeList as integer arrays. Edge i links the nodes names[src[i]] and names[dst[i]] with the weight
+        w1[i] from src to dst and w2[i] from dst to src (NaN for unidirectional edges). The type of node j is
+        prefixes[node_type[j]].
+    """
+
+    def __init__(self, prefixes, names, node_type, src, dst, w1, w2):
+        self.prefixes = prefixes
+        self.names = names
+        self.node_type = np.asarray(node_type, dtype=np.int8)
+        self.src = np.asarray(src, dtype=np.int32)
+        self.dst = np.asarray(dst, dtype=np.int32)
+        self.w1 = np.asarray(w1, dtype=np.float64)
+        self.w2 = np.asarray(w2, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.src)
+
+    def to_sparse(self):
+        """
+            Return the weighted adjacency matrix of the graph as a scipy.sparse CSR matrix, in which entry (i, j) is the
+            weight from names[i] to names[j]. As in EdgeList.convert_to_dict, unidirectional edges have weight 0 back
+            and the last edge between two nodes sets their weights.
+        """
+        n_nodes = len(self.names)
+        rows = np.stack([self.src, self.dst], axis=1).ravel().astype(np.int64)
+        cols = np.stack([self.dst, self.src], axis=1).ravel().astype(np.int64)
+        weights = np.stack([self.w1, np.nan_to_num(self.w2, nan=0.0)], axis=1).ravel()
+        # Keep the last weight of every (row, col) pair, as the coo conversion would add them up.
+        _, first_reversed = np.unique((rows * n_nodes + cols)[::-1], return_index=True)
+        last = len(rows) - 1 - first_reversed
+        return scipy.sparse.csr_matrix((weights[last], (rows[last], cols[last])), shape=(n_nodes, n_nodes))
+
+    def export_sparse(self, path):
+        """
+            Write the graph for graph analytics as uncompressed .npy files that can be memory-mapped: the arrays of the
+            CSR adjacency matrix of to_sparse to path.indptr.npy, path.indices.npy, path.data.npy and path.shape.npy,
+            and the node names, in the order of the rows, as in save to path.names.npy and path.name_ends.npy.
+            load_sparse reads them back.
+        """
+        matrix = self.to_sparse()
+        names, name_ends = self.encode_names(self.names)
+        arrays = {'indptr': matrix.indptr, 'indices': matrix.indices, 'data': matrix.data,
+                  'shape': np.array(matrix.shape, dtype=np.int64), 'names': names, 'name_ends': name_ends}
+        for key, array in arrays.items():
+            np.save('{}.{}.npy'.format(path, key), array)
+
+    @staticmethod
+    def load_sparse(path, mmap_mode='r'):
+        """
+            Read a graph written by export_sparse. The arrays of the CSR matrix are memory-mapped with mmap_mode.
+            :return: The CSR adjacency matrix and the list of node names.
+        """
+        indptr, indices, data, shape = [np.load('{}.{}.npy'.format(path, key), mmap_mode=mmap_mode)
+                                        for key in ['indptr', 'indices', 'data', 'shape']]
+        matrix = scipy.sparse.csr_matrix((data, indices, indptr), shape=tuple(shape.tolist()), copy=False)
+        names = EdgeTable.decode_names(np.load(path + '.names.npy'), np.load(path + '.name_ends.npy'))
+        return matrix, names
+
+    @staticmethod
+    def encode_names(names):
+        """Return the names as their concatenated UTF-8 bytes and the offset where each name ends."""
+        encoded = [name.encode('utf-8') for name in names]
+        name_ends = np.cumsum([len(_) for _ in encoded], dtype=np.int64)
+        return np.frombuffer(b''.join(encoded), dtype=np.uint8), name_ends
+
+    @staticmethod
+    def decode_names(blob, name_ends):
+        """Inverse of encode_names."""
+        blob = blob.tobytes()
+        ends = name_ends.tolist()
+        return [blob[start:end].decode('utf-8') for start, end in zip([0] + ends[:-1], ends)]
+
+    def save(self, edgefile):
+        """
+            Write the edges in the binary edgelist format, an .npz file with the integer node ids, the type codes, the
+            float32 weights and the table of node names. The names are stored as they are, commas included, as their
+            concatenated UTF-8 bytes and the offset where each name ends.
+        """
+        names, name_ends = self.encode_names(self.names)
+        np.savez(edgefile, prefixes=np.array(self.prefixes, dtype=str),
+                 names=names, name_ends=name_ends,
+                 node_type=self.node_type, src=self.src, dst=self.dst,
+                 w1=self.w1.astype(np.float32), w2=self.w2.astype(np.float32))
+
+    @classmethod
+    def load(cls, edgefile):
+        """Read an edgelist written by save."""
+        with np.load(edgefile) as data:
+            names = cls.decode_names(data['names'], data['name_ends'])
+            return cls(data['prefixes'].tolist(), names, data['node_type'],
+                       data['src'], data['dst'], data['w1'], data['w2'])
+
+    def to_edgelist(self):
+        """Return the edges as a list of (n1, n2, w1, w2) tuples, as read by read_edgelist."""
+        names = self.names
+        return [(names[s], names[d], w1, w2) if w2 == w2 else (names[s], names[d], w1)
+                for s, d, w1, w2 in zip(self.src.tolist(), self.dst.tolist(), self.w1.tolist(), self.w2.tolist())]
+
+
+class TableProfile:
+    """
+        Single pass over the cells of a dataframe, which finds the numeric columns, converts the cells to strings as
+        EdgeList.convert_cell_value does, tokenizes them and counts the frequency of every token. Token i comes from
+        the cell in row rows[i] and column cols[i], and occurs counts[i] times in the whole table (0 for empty tokens).
+    """
+
+    def __init__(self, df, flatten, intersection):
+        self.columns = list(df.columns)
+        self.numeric = np.zeros(len(self.columns), dtype=bool)
+        # Convert the cells column by column, then lay them out row by row, in the order of df.iterrows.
+        cells = np.empty((len(df), len(self.columns)), dtype=object)
+        for col_idx in range(len(self.columns)):
+            cells[:, col_idx], self.numeric[col_idx] = EdgeList.convert_column(df.iloc[:, col_idx])
+        cells = cells.ravel()
+        # Empty cells are None or ''.
+        positions = np.flatnonzero(cells.astype(bool))
+
+        # Tokenize cell values depending on the chosen strategy.
+        self.tokens, owners = EdgeList.split_values(cells[positions], flatten, intersection)
+        self.rows, self.cols = np.divmod(positions[owners], len(self.columns))
+
+        token_ids, vocabulary = pd.factorize(self.tokens)
+        frequencies = np.bincount(token_ids, minlength=len(vocabulary))
+        frequencies[vocabulary == ''] = 0
+        self.counts = frequencies[token_ids]
+        self.frequencies = pd.Series(frequencies, index=vocabulary)[frequencies > 0]
+
+
+def is_binary_edgelist(edgefile):
+    return edgefile.endswith('.npz')
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input_file', required=True, type=str, help='Path to input csv file to translate.')
-    parser.add_argument('-o', '--output_file', required=True, type=str, help='Path to output edgelist_file.')
+    parser.add_argument('-o', '--output_file', required=True, type=str, help='Path to output edgelist_file, in the binary format if it ends with .npz.')
     # parser.add_argument('--tokenization', required=True, type=str, choices=['token', 'flatten', 'all'],
     #                     help='Tokenization strategy to use.')
     parser.add_argument('--info_file', required=False, type=str, default=None,
                         help='Path to info file with df boundaries.')
 
     parser.add_argument('--export', required=False, action='store_true',
-                        help='Flag for exporting the edgelist in networkx format.')
+                        help='Flag for exporting the graph as the uncompressed .npy arrays of a scipy.sparse CSR matrix and its node names, which EdgeTable.load_sparse memory-maps.')
+    parser.add_argument('--chunksize', required=False, type=int, default=100000,
+                        help='Number of rows read at a time when the table is streamed into a text edgelist.')
 
     return parser.parse_args()
 
@@ -101,6 +236,41 @@ class EdgeList:
             cell_value = str(original_value)
         return cell_value
 
+    @staticmethod
+    def is_numeric_value(value):
+        try:
+            float(value)
+            return True
+        except ValueError:
+            return False
+
+    @classmethod
+    def convert_column(cls, column):
+        '''
+        Convert a whole column of cell values to strings, with the same results as convert_cell_value. Numeric columns
+        are converted with array operations, other columns convert each distinct value once.
+        :param column: The column to convert, as a Series.
+        :return: Object array of the converted values, None for the empty ones, and whether every value in the
+        column is numeric.
+        '''
+        values = column.to_numpy()
+        if values.dtype.kind in 'biuf':
+            floats = values.astype(np.float64)
+            converted = np.full(len(floats), None, dtype=object)
+            # Values that fit in int64 are truncated in bulk, infinities and larger values go through
+            # convert_cell_value.
+            exact = np.abs(floats) < 2.0 ** 63
+            converted[exact] = np.trunc(floats[exact]).astype(np.int64).astype(str)
+            for i in np.flatnonzero(~exact & ~np.isnan(floats)):
+                converted[i] = cls.convert_cell_value(values[i])
+            return converted, True
+
+        # Missing values get code -1, which picks the trailing None.
+        codes, uniques = pd.factorize(values)
+        converted = np.array([cls.convert_cell_value(v) for v in uniques] + [None], dtype=object)
+        numeric = all(cls.is_numeric_value(v) for v in uniques)
+        return converted[codes], numeric
+
     def _parse_smoothing_method(self, smoothing_method):
         '''
         Convert the smoothing method supplied by the user into parameters that can be used by the edgelist.
@@ -187,34 +357,30 @@ class EdgeList:
 
     @staticmethod
     def evaluate_frequencies(flatten, df, intersection):
-        if flatten and intersection:
-            split_values = []
-            for val in df.values.ravel().tolist():
-                if val not in intersection:
-                    try:
-                        split = val.split('_')
-                    except AttributeError:
-                        split = [str(val)]
-                else:
-                    split = [str(val)]
-                split_values += split
-            frequencies = dict(Counter(split_values))
-        elif flatten:
-            split_values = []
-            for val in df.values.ravel().tolist():
-                try:
-                    split = val.split('_')
-                except AttributeError:
-                    split = [str(val)]
-                split_values += split
-            frequencies = dict(Counter(split_values))
-        else:
-            frequencies = dict(Counter([str(_) for _ in df.values.ravel().tolist() if _ == _]))
-        # Remove null values if they somehow slipped in.
-        frequencies.pop('', None)
-        frequencies.pop(np.nan, None)
+        return TableProfile(df, flatten, intersection).frequencies.to_dict()
 
-        return frequencies
+    @staticmethod
+    def split_values(values, flatten, intersection):
+        '''
+        Tokenize an array of string values as prepare_split does, splitting each distinct value once.
+        :param values: object array of strings.
+        :param flatten: if True, split the values on underscores, except the ones in the intersection.
+        :param intersection: list of values that are not split.
+        :return: the object array of all tokens, in order, and the index of the value that each token comes from.
+        '''
+        codes, uniques = pd.factorize(values)
+        intersection = set(intersection)
+        parts = [[v] if not flatten or v in intersection else v.split('_') for v in uniques]
+        unique_tokens = np.array(list(itertools.chain.from_iterable(parts)), dtype=object)
+        unique_lengths = np.array([len(p) for p in parts], dtype=np.int64)
+        unique_starts = np.cumsum(unique_lengths) - unique_lengths
+
+        # Gather the tokens of every value from the tokens of its distinct value.
+        lengths = unique_lengths[codes]
+        owners = np.repeat(np.arange(len(values)), lengths)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        tokens = unique_tokens[np.repeat(unique_starts[codes], lengths) + offsets]
+        return tokens, owners
 
     @staticmethod
     def prepare_split(cell_value, flatten, intersection):
@@ -234,6 +400,8 @@ class EdgeList:
         in the graph, built according to the parameters passed to the function.
 
         :param df: dataframe to convert into graph
+        :param edgefile: path of the edgelist file to write, if None the edges are only kept in memory. Paths ending in
+        .npz are written in the binary format of EdgeTable.save, other paths as comma-separated text.
         :param sim_list: optional, list of pairs of similar values
         :param smoothing_method: one of {no, smooth, inverse_smooth, log, inverse}
         :param flatten: if set to True, spread multi-word tokens over multiple nodes. If set to false, all unique cell
@@ -241,94 +409,91 @@ class EdgeList:
         """
         self._parse_smoothing_method(smoothing_method)
         # df = df.fillna('')
-        self.edgelist = []
-
-        numeric_columns = []
-
-        for col in df.columns:
-            try:
-                df[col].dropna(axis=0).astype(float).astype(str)
-                numeric_columns.append(col)
-            except ValueError:
-                pass
+        self.prefixes = prefixes
+        type_codes = {prefix.split('__')[1]: code for code, prefix in enumerate(prefixes)}
 
         if info_file:
             intersection = self.find_intersection_flatten(df, info_file)
         else:
             intersection = []
 
-        frequencies = self.evaluate_frequencies(flatten, df, intersection)
+        profile = TableProfile(df, flatten, intersection)
+        weights, weight_str = self.smooth_counts(profile.counts)
+        rid_names, token_names, cid_names = self.node_names(df.index, profile, profile.numeric)
+        numeric = profile.numeric[profile.cols]
+
+        # Node ids are assigned in order of appearance along the edges.
+        sequence = np.stack([rid_names, token_names, rid_names, cid_names], axis=1).ravel()
+        codes, names = pd.factorize(sequence)
+        n_tokens = len(profile.tokens)
+        sequence_types = np.stack([np.full(n_tokens, type_codes['idx']),
+                                   np.where(numeric, type_codes['tn'], type_codes['tt']),
+                                   np.full(n_tokens, type_codes['idx']),
+                                   np.full(n_tokens, type_codes['cid'])], axis=1).ravel()
+        _, first = np.unique(codes, return_index=True)
+        codes = codes.reshape(-1, 4)
+
+        self._names = list(names)
+        self._node_type = sequence_types[first].astype(np.int8)
+        self._src = np.repeat(codes[:, 0], 2).astype(np.int32)
+        self._dst = codes[:, [1, 3]].ravel().astype(np.int32)
+        self._w1 = np.stack([np.ones(n_tokens), weights], axis=1).ravel()
+        self._w2 = np.stack([weights, np.ones(n_tokens)], axis=1).ravel()
+
+        if edgefile and is_binary_edgelist(edgefile):
+            self.get_edge_table().save(edgefile)
+        elif edgefile:
+            with open(edgefile, 'w') as fp:
+                fp.write(','.join(prefixes) + '\n')
+                self.write_edge_rows(fp, rid_names, token_names, cid_names, weight_str)
+
+    def smooth_counts(self, counts):
+        '''
+        Smooth the frequency of every token, computing each distinct count once.
+        :param counts: array with the frequency of every token, 0 for the tokens without a frequency, which get weight 1.
+        :return: the array of weights and the object array of the weights as written in the edgelist file.
+        '''
+        hit = counts > 0
+        distinct, inverse = np.unique(counts[hit], return_inverse=True)
+        smoothed = [self.smooth_freq(int(c)) for c in distinct]
+        weights = np.ones(len(counts))
+        weights[hit] = np.array(smoothed, dtype=np.float64)[inverse]
+        weight_str = np.full(len(counts), '1', dtype=object)
+        weight_str[hit] = np.array([str(w) for w in smoothed], dtype=object)[inverse]
+        return weights, weight_str
 
-        count_rows = 1
-        with open(edgefile, 'w') as fp:
-            fp.write(','.join(prefixes) + '\n')
-            # Iterate over all rows in the df
-            # for idx, r in tqdm(df.iterrows()):
-            for idx, r in df.iterrows():
-                rid = 'idx__' + str(idx)
-
-                # Remove nans from the row
-                row = r.dropna()
-                # Create a node for the current row id.
-                for col_idx, col in enumerate(df.columns):
-                    try:
-                        og_value = row[col]
-                        cell_value = self.convert_cell_value(og_value)
-                        # If cell value is None, continue
-                        if not cell_value:
-                            continue
-
-                        # Tokenize cell_value depending on the chosen strategy.
-                        valsplit = self.prepare_split(cell_value, flatten, intersection)
-
-                        for split in valsplit:
-                            try:
-                                smoothed_f = self.smooth_freq(frequencies[split])
-                            except KeyError:
-                                smoothed_f = 1
-                            n1 = rid
-                            if col in numeric_columns:
-                                # n2 = 'tn__' + split
-                                n2 = 'tn__ ' + split
-                            else:
-                                # n2 = 'tt__' + split
-                                n2 = 'tt__ ' + split
-
-                            w1 = 1
-                            w2 = smoothed_f
-                            self.edgelist.append((n1, n2, w1, w2))
-                            edgerow = '{},{},{},{}\n'.format(n1, n2, w1, w2)
-
-                            fp.write(edgerow)
-                            if col in numeric_columns:
-                                # n2 = 'tn__' + split
-                                n2 = 'tn__ ' + split
-                            else:
-                                # n2 = 'tt__' + split
-                                n2 = 'tt__ ' + split
-
-                            n2 = f'cid__{col_idx} ' + col
-                            w1 = smoothed_f
-                            w2 = 1
-                            self.edgelist.append((n1, n2, w1, w2))
-
-                            edgerow = '{},{},{},{}\n'.format(n1, n2, w1, w2)
-
-                            fp.write(edgerow)
-                    except KeyError:
-                        continue
-
-                # print('\r# {:0.1f} - {:}/{:} tuples'.format(count_rows / len(df) * 100, count_rows, len(df)), end='')
-                count_rows += 1
-
-        # print('')
+    @staticmethod
+    def node_names(index, profile, numeric):
+        '''
+        Name the nodes of the edges of every token: every token links its row to the token node, then its row to the
+        column node.
+        :param index: the index of the dataframe, which names the rows.
+        :param profile: the TableProfile of the dataframe.
+        :param numeric: array telling whether each column is numeric.
+        :return: object arrays with the names of the row, token and column node of every token.
+        '''
+        rid_names = np.array(['idx__' + str(idx) for idx in index], dtype=object)[profile.rows]
+        token_names = np.where(numeric[profile.cols], 'tn__ ', 'tt__ ').astype(object) + profile.tokens
+        cid_names = np.array([f'cid__{col_idx} ' + col for col_idx, col in enumerate(profile.columns)],
+                             dtype=object)[profile.cols]
+        return rid_names, token_names, cid_names
+
+    @staticmethod
+    def write_edge_rows(fp, rid_names, token_names, cid_names, weight_str):
+        edgerows = np.stack([rid_names + ',' + token_names + ',1,' + weight_str + '\n',
+                             rid_names + ',' + cid_names + ',' + weight_str + ',1\n'], axis=1).ravel()
+        fp.writelines(edgerows)
+
+    def get_edge_table(self):
+        """Return the edges as an EdgeTable, which Graph and CSRGraph build from without parsing node names."""
+        return EdgeTable(self.prefixes, self._names, self._node_type, self._src, self._dst, self._w1, self._w2)
 
     def get_edgelist(self):
-        return self.edgelist
+        return self.get_edge_table().to_edgelist()
 
     def convert_to_dict(self):
         self.graph_dict = {}
-        for edge in self.edgelist:
+        for edge in self.get_edgelist():
             if len(edge) == 4:
                 n1, n2, w1, w2 = edge
             elif len(edge) == 3:
@@ -363,6 +528,47 @@ class EdgeList:
         return numeric_dict
 
 
+class StreamingEdgeList(EdgeList):
+    def __init__(self, input_file, edgefile, prefixes, smoothing_method='no', flatten=False, chunksize=100000):
+        """Write the edgelist of a csv table without loading the table or its edges in memory. The table is read
+        twice in chunks of rows: the first pass finds the numeric columns and counts the frequency of every token, the
+        second one writes the edges of every chunk to the text edgelist. Only the frequencies are kept in memory. The
+        edgelist is the same as the one of EdgeList on the whole table, as long as pandas infers the same values in
+        every chunk.
+
+        :param input_file: path of the csv table
+        :param edgefile: path of the text edgelist file to write
+        :param smoothing_method: one of {no, smooth, inverse_smooth, log, inverse}
+        :param flatten: if set to True, spread multi-word tokens over multiple nodes
+        :param chunksize: number of rows in every chunk
+        """
+        if is_binary_edgelist(edgefile):
+            raise ValueError('The binary edgelist format needs all edges in memory, use EdgeList instead.')
+        self._parse_smoothing_method(smoothing_method)
+        self.prefixes = prefixes
+        self.edgefile = edgefile
+
+        numeric = None
+        frequencies = pd.Series(dtype=np.float64)
+        for chunk in pd.read_csv(input_file, chunksize=chunksize):
+            profile = TableProfile(chunk, flatten, [])
+            numeric = profile.numeric if numeric is None else numeric & profile.numeric
+            frequencies = frequencies.add(profile.frequencies, fill_value=0)
+
+        with open(edgefile, 'w') as fp:
+            fp.write(','.join(prefixes) + '\n')
+            for chunk in pd.read_csv(input_file, chunksize=chunksize):
+                profile = TableProfile(chunk, flatten, [])
+                found = frequencies.index.get_indexer(profile.tokens)
+                counts = np.where(found >= 0, frequencies.to_numpy()[found], 0).astype(np.int64)
+                weights, weight_str = self.smooth_counts(counts)
+                rid_names, token_names, cid_names = self.node_names(chunk.index, profile, numeric)
+                self.write_edge_rows(fp, rid_names, token_names, cid_names, weight_str)
+
+    def get_edge_table(self):
+        raise ValueError(f'The edges of a StreamingEdgeList are only written to {self.edgefile}.')
+
+
 if __name__ == '__main__':
     args = parse_args()
     dfpath = args.input_file
@@ -375,21 +581,18 @@ if __name__ == '__main__':
     else:
         info = None
 
-    df = pd.read_csv(dfpath, low_memory=False)
-
     pref = ['3#__tn', '3$__tt', '5$__idx', '1$__cid']
 
-    el = EdgeList(df, edgefile, pref, info, flatten=True)
+    if info or args.export or is_binary_edgelist(edgefile):
+        df = pd.read_csv(dfpath, low_memory=False)
+        el = EdgeList(df, edgefile, pref, info, flatten=True)
+    else:
+        # Stream the table, so that tables larger than memory can be converted.
+        el = StreamingEdgeList(dfpath, edgefile, pref, flatten=True, chunksize=args.chunksize)
 
     if args.export:
-        el.convert_to_dict()
-        gdict = el.convert_to_numeric()
-        g_nx = nx.from_dict_of_lists(gdict)
         n, _ = osp.splitext(edgefile)
-        nx_fname = n + '.nx'
-        pkl_fname = n + '.pkl'
-        pickle.dump(g_nx, open(nx_fname, 'wb'))
-        pickle.dump(gdict, open(pkl_fname, 'wb'))
+        el.get_edge_table().export_sparse(n)
 
     # Loading the graph to make sure it can load the edgelist.
     # g = Graph(el.get_edgelist(), prefixes=pref)
@@ -1,12 +1,57 @@
+import itertools
 import multiprocessing as mp
+import zlib
+from collections import Counter
 
 import gensim.models as models
 import numpy as np
-from gensim.models import Word2Vec, FastText, Doc2Vec
+from gensim.models import Word2Vec, FastText, Doc2Vec, KeyedVectors
+from gensim.models.fasttext import compute_ngrams_bytes
+
+from EmbDI.utils import decode_words
+
+# Extension of the embeddings file in every output format: 'text' is the word2vec text format, 'gensim' the native
+# KeyedVectors format, 'npy' a float32 matrix with the vocabulary in a .vocab file next to it, and 'none' writes nothing.
+OUTPUT_FORMATS = {'text': '.emb', 'gensim': '.kv', 'npy': '.emb.npy', 'none': ''}
+
+
+def stable_hash(string):
+    """Hash function that, unlike the builtin hash, does not change between processes. Used by gensim to seed the
+    initial vectors, so that seeded trainings start from the same vectors in every process.
+    """
+    return zlib.crc32(string.encode('utf-8'))
+
+
+# Default and maximum number of buckets of the fasttext n-gram vectors, as in gensim.
+MAX_BUCKETS = 2000000
+
+
+def fasttext_buckets(walks, write_walks, min_count=2, min_n=3, max_n=6):
+    """Return the number of buckets of the fasttext n-gram vectors for a walks corpus: twice the distinct character
+    n-grams of its vocabulary, so that few of them share a bucket, and at most MAX_BUCKETS. The gensim default of
+    MAX_BUCKETS allocates and trains the same large matrix for every table, however few words it has.
+
+    :param walks: path to the walks file (if write_walks == True), list of walks otherwise.
+    :param write_walks: flag used to read walks from a file rather than taking them from memory.
+    :param min_count: minimum frequency of the words in the vocabulary.
+    :param min_n: minimum length of the character n-grams.
+    :param max_n: maximum length of the character n-grams.
+    """
+    if write_walks:
+        with open(walks, 'r') as fp:
+            counts = Counter(itertools.chain.from_iterable(line.split() for line in fp))
+    else:
+        counts = Counter(itertools.chain.from_iterable(walks))
+    ngrams = set()
+    for word, count in counts.items():
+        if count >= min_count:
+            ngrams.update(compute_ngrams_bytes(word, min_n, max_n))
+    return max(1, min(MAX_BUCKETS, 2 * len(ngrams)))
 
 
 def learn_embeddings(output_embeddings_file, walks, write_walks, dimensions, window_size, training_algorithm='word2vec',
-                     learning_method='skipgram', workers=mp.cpu_count(), sampling_factor=0.001):
+                     learning_method='skipgram', workers=mp.cpu_count(), sampling_factor=0.001, seed=None,
+                     dictionary=None, output_format='text', bucket=None, init_vectors=None, epochs=None):
     """Function used to train the embeddings based on the given walks corpus. Multiple parameters are available to
     tweak the training procedure. The resulting embedding file will be saved in the given path to be used later in the
     experimental phase.
@@ -19,7 +64,34 @@ def learn_embeddings(output_embeddings_file, walks, write_walks, dimensions, win
     :param training_algorithm: either fasttext or word2vec.
     :param learning_method: skipgram or CBOW
     :param workers: number of CPU workers to be used in during the training. Default = mp.cpu_count().
+    :param seed: seed for the initial vectors and the sampling, if None the gensim default is used.
+    :param dictionary: dictionary of the words interned by intern_node_names, if the walks hold interned words.
+    :param output_format: format of the embeddings file, one of OUTPUT_FORMATS.
+    :param bucket: number of buckets of the fasttext n-gram vectors, if None it is sized by fasttext_buckets.
+    :param init_vectors: optional KeyedVectors, e.g. pre-trained embeddings, to start the training from: the words of
+    the vocabulary found in them start from their vectors instead of random ones (see warm_start).
+    :param epochs: number of training epochs, if None the gensim default is used. A warm start needs fewer of them.
     """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('Unknown output format {}'.format(output_format))
+    if seed is None:
+        model_args = {}
+    else:
+        model_args = {'seed': seed, 'hashfxn': stable_hash}
+    if epochs is not None:
+        model_args['epochs'] = epochs
+
+    if init_vectors is not None:
+        if training_algorithm == 'doc2vec':
+            raise ValueError('Warm start is not supported with doc2vec')
+        if init_vectors.vector_size != dimensions:
+            raise ValueError('Cannot start the training from vectors of {} dimensions instead of {}'.format(
+                init_vectors.vector_size, dimensions))
+        # The model is only created here, it is trained below once the vectors are initialized.
+        corpus = None
+    else:
+        corpus = walks
+
     if training_algorithm == 'word2vec':
         if learning_method == 'skipgram':
             sg = 1
@@ -28,14 +100,12 @@ def learn_embeddings(output_embeddings_file, walks, write_walks, dimensions, win
         else:
             raise ValueError('Unknown learning method {}'.format(learning_method))
         if write_walks:
-            model = Word2Vec(corpus_file=walks, vector_size=dimensions, window=window_size, min_count=2, sg=sg,
+            model = Word2Vec(corpus_file=corpus, vector_size=dimensions, window=window_size, min_count=2, sg=sg,
                              workers=workers,
-                             sample=sampling_factor)
-            model.wv.save_word2vec_format(output_embeddings_file, binary=False)
+                             sample=sampling_factor, **model_args)
         else:
-            model = Word2Vec(sentences=walks, size=dimensions, window=window_size, min_count=2, sg=sg, workers=workers,
-                             sample=sampling_factor)
-            model.wv.save_word2vec_format(output_embeddings_file, binary=False)
+            model = Word2Vec(sentences=corpus, vector_size=dimensions, window=window_size, min_count=2, sg=sg, workers=workers,
+                             sample=sampling_factor, **model_args)
     elif training_algorithm == 'doc2vec':
         if learning_method == 'skipgram':
             sg = 1
@@ -46,22 +116,121 @@ def learn_embeddings(output_embeddings_file, walks, write_walks, dimensions, win
         if write_walks:
             model = Doc2Vec(corpus_file=walks, vector_size=dimensions, window=window_size, min_count=2, sg=sg,
                             workers=workers,
-                            sample=sampling_factor)
-            model.wv.save_word2vec_format(output_embeddings_file, binary=False)
+                            sample=sampling_factor, **model_args)
         else:
             model = Doc2Vec(sentences=walks, vector_size=dimensions, window=window_size, min_count=2, sg=sg, workers=workers,
-                            sample=sampling_factor)
-            model.wv.save_word2vec_format(output_embeddings_file, binary=False)
+                            sample=sampling_factor, **model_args)
     elif training_algorithm == 'fasttext':
+        if bucket is None:
+            bucket = fasttext_buckets(walks, write_walks, min_count=2)
+        if write_walks:
+            model = FastText(corpus_file=corpus, window=window_size, min_count=2, workers=workers, vector_size=dimensions,
+                             bucket=bucket, **model_args)
+        else:
+            model = FastText(sentences=corpus, vector_size=dimensions, workers=workers, min_count=2, window=window_size,
+                             bucket=bucket, **model_args)
+
+    if init_vectors is not None:
         if write_walks:
-            model = FastText(corpus_file=walks, window=window_size, min_count=2, workers=workers, vector_size=dimensions)
-            model.wv.save_word2vec_format(output_embeddings_file)
+            corpus_args = {'corpus_file': walks}
         else:
-            model = FastText(sentences=walks, vector_size=dimensions, workers=workers, min_count=2, window=window_size)
-            model.wv.save_word2vec_format(output_embeddings_file)
+            corpus_args = {'corpus_iterable': walks}
+        model.build_vocab(**corpus_args)
+        warm_start(model, init_vectors, dictionary)
+        model.train(total_examples=model.corpus_count, total_words=model.corpus_total_words, epochs=model.epochs,
+                    **corpus_args)
+
+    if dictionary is not None:
+        # Words were interned while building the graph, the embeddings are saved with the original words.
+        model.wv.index_to_key = decode_words(model.wv.index_to_key, dictionary)
+        model.wv.key_to_index = {word: idx for idx, word in enumerate(model.wv.index_to_key)}
+    save_embeddings(model.wv, output_embeddings_file, output_format)
     return model
 
 
+def warm_start(model, init_vectors, dictionary=None):
+    """Initialize the vectors of the vocabulary words that are found in init_vectors with their vectors, before the
+    model is trained. The table embeddings then start close to the pre-trained space, so they need fewer epochs and
+    they are aligned starting from the identity.
+
+    :param model: word2vec or fasttext model, with its vocabulary built.
+    :param init_vectors: KeyedVectors to take the vectors from.
+    :param dictionary: dictionary of the words interned by intern_node_names, if the walks hold interned words.
+    :return: number of initialized words.
+    """
+    words = model.wv.index_to_key
+    if dictionary is not None:
+        words = decode_words(words, dictionary)
+    found = [(idx, init_vectors.key_to_index[word]) for idx, word in enumerate(words)
+             if word in init_vectors.key_to_index]
+    if not found:
+        return 0
+    rows, init_rows = map(list, zip(*found))
+    vectors = init_vectors.vectors[init_rows]
+    if isinstance(model, FastText):
+        # The vector of a word is the mean of its own vector and of its n-gram vectors, the own vector is set so that
+        # the mean is the initial vector.
+        wv = model.wv
+        for row, vector in zip(rows, vectors):
+            buckets = wv.buckets_word[row]
+            wv.vectors_vocab[row] = (len(buckets) + 1) * vector - wv.vectors_ngrams[buckets].sum(axis=0)
+        wv.adjust_vectors()
+    else:
+        model.wv.vectors[rows] = vectors
+    return len(rows)
+
+
+def embeddings_files(embeddings_file, output_format):
+    """Return the files written by save_embeddings for the given embeddings file and output format.
+    """
+    if output_format == 'none':
+        return []
+    if output_format == 'npy':
+        return [embeddings_file, embeddings_file + '.vocab']
+    return [embeddings_file]
+
+
+def save_embeddings(wv, embeddings_file, output_format='text'):
+    """Save the vectors of the vocabulary in the given output format (see OUTPUT_FORMATS). The binary formats skip
+    formatting every float as text, and load in a fraction of the time.
+
+    :param wv: KeyedVectors of the trained model.
+    :param embeddings_file: path of the embeddings file.
+    :param output_format: one of OUTPUT_FORMATS.
+    """
+    if output_format == 'text':
+        wv.save_word2vec_format(embeddings_file, binary=False)
+    elif output_format == 'gensim':
+        # Only the vectors of the vocabulary are kept, as in the text format, without the n-grams of fasttext.
+        kv = KeyedVectors(wv.vector_size)
+        kv.add_vectors(wv.index_to_key, wv.vectors)
+        kv.save(embeddings_file, separately=[])
+    elif output_format == 'npy':
+        # The file object stops numpy from appending .npy to the path.
+        with open(embeddings_file, 'wb') as fp:
+            np.save(fp, wv.vectors.astype(np.float32, copy=False))
+        with open(embeddings_file + '.vocab', 'w', encoding='utf-8') as fp:
+            fp.write('\n'.join(wv.index_to_key))
+
+
+def read_embeddings(embeddings_file):
+    """Load the embeddings saved by save_embeddings, with the output format given by the extension of the file.
+
+    :param embeddings_file: path of the embeddings file.
+    :return: KeyedVectors of the embeddings.
+    """
+    if embeddings_file.endswith(OUTPUT_FORMATS['gensim']):
+        return KeyedVectors.load(embeddings_file)
+    if embeddings_file.endswith(OUTPUT_FORMATS['npy']):
+        vectors = np.load(embeddings_file)
+        with open(embeddings_file + '.vocab', 'r', encoding='utf-8') as fp:
+            words = fp.read().split('\n')
+        kv = KeyedVectors(vectors.shape[1])
+        kv.add_vectors(words, vectors)
+        return kv
+    return KeyedVectors.load_word2vec_format(embeddings_file, binary=False)
+
+
 def return_combined(row, wv, n_dimensions):
     vector = []
     for word in row[:]:
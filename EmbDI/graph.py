@@ -17,10 +17,13 @@ limitations under the License.
 import datetime
 import math
 import random
+from array import array
 
 from tqdm import tqdm
 
-from EmbDI.aliased_randomizer import prepare_aliased_randomizer
+from EmbDI.aliased_randomizer import prepare_alias_tables
+from EmbDI.csr_graph import CSRGraph
+from EmbDI.edgelist import EdgeTable
 from EmbDI.utils import *
 from EmbDI.logging import *
 
@@ -39,7 +42,7 @@ class Node:
     """
 
     def __init__(self, name, type, node_class, numeric):
-        self.random_neigh = None
+        self.odds = self.alias = self.offset = None
         self.neighbors = dict()
         self.neighbor_names = []
         self.n_similar = 1
@@ -70,7 +73,12 @@ class Node:
             return self.name
 
     def get_weighted_random_neighbor(self):
-        return self.random_neigh()
+        r = random.random() * self.number_neighbors
+        i = int(r)
+        if (r - i) > self.odds[self.offset + i]:
+            return self.neighbor_names[self.alias[self.offset + i]]
+        else:
+            return self.neighbor_names[i]
 
     def get_random_neighbor(self):
         # return np.random.choice(self.neighbor_names, size=1)[0]
@@ -91,13 +99,16 @@ class Node:
     def get_random_replacement(self):
         return random.choices(self.similar_tokens, weights=self.similar_distance, k=1)[0]
 
-    def normalize_neighbors(self, uniform):
+    def normalize_neighbors(self, uniform, odds, alias, offset):
         self.neighbor_names = np.array(list(self.neighbors.keys()))
         self.number_neighbors = len(self.neighbor_names)
         # self.neighbor_frequencies = np.array(list(self.neighbors.values()))
 
-        # if not uniform:
-        self.random_neigh = prepare_aliased_randomizer(self.neighbor_names, np.array(list(self.neighbors.values())))
+        # The alias table of the node is the slice [offset, offset + number_neighbors) of the tables of the graph,
+        # with aliases relative to the offset.
+        self.odds = odds
+        self.alias = alias
+        self.offset = offset
         self.startfrom = np.array(self.startfrom)
         self.neighbors = None
 
@@ -262,6 +273,12 @@ class Graph:
         else:
             print('# All values will be tokenized. ')
 
+        if isinstance(edgelist, EdgeTable):
+            self._from_csr(CSRGraph(edgelist, prefixes, flatten))
+            if sim_list:
+                self.add_similarities(sim_list)
+            return
+
         # pbar = tqdm()
         # for line in tqdm(edgelist, desc='# Loading edgelist_file.'):
         for line in edgelist:
@@ -342,21 +359,54 @@ class Graph:
                 self.cell_list.append(node_name)
             if len(self.nodes[node_name].neighbors) == 0:
                 raise ValueError('Node {} has no neighbors'.format(node_name))
-            else:
-                self.nodes[node_name].normalize_neighbors(uniform=self.uniform)
+        self._prepare_alias_tables()
         for node_name in to_delete:
             self.nodes.pop(node_name)
         # self.edges = None  # remove the edges list to save memory
         if sim_list:
             self.add_similarities(sim_list)
 
+    def _prepare_alias_tables(self):
+        # The alias tables of all nodes are built at once in flat arrays, each node draws from its own slice.
+        degrees = np.array([len(node.neighbors) for node in self.nodes.values()], dtype=np.int64)
+        indptr = np.zeros(len(degrees) + 1, dtype=np.int64)
+        np.cumsum(degrees, out=indptr[1:])
+        weights = np.fromiter((w for node in self.nodes.values() for w in node.neighbors.values()),
+                              dtype=np.float64, count=indptr[-1])
+        odds, alias = prepare_alias_tables(indptr, weights)
+        self._set_alias_tables(indptr, odds, alias)
+
+    def _set_alias_tables(self, indptr, odds, alias):
+        degrees = np.diff(indptr)
+        odds = array('d', odds)
+        alias = array('l', alias - np.repeat(indptr[:-1], degrees))
+        for node, offset in zip(self.nodes.values(), indptr[:-1].tolist()):
+            node.normalize_neighbors(self.uniform, odds, alias, offset)
+
+    def _from_csr(self, csr):
+        """Create the nodes from the arrays of a CSRGraph, which has the same nodes in the same order, and reuse its
+        alias tables.
+        """
+        self.uniform = csr.uniform
+        for i, node_name in enumerate(csr.get_node_list()):
+            node_prefix = csr.types[csr.node_type[i]]
+            node = Node(node_name, node_prefix, node_class=self.node_classes[node_prefix],
+                        numeric=self.node_is_numeric[node_prefix])
+            lo, hi = csr.indptr[i], csr.indptr[i + 1]
+            node.neighbors = dict(zip(csr.vocab[csr.indices[lo:hi]].tolist(), csr.weights[lo:hi].tolist()))
+            node.startfrom = csr.vocab[csr.start_indices[csr.start_indptr[i]:csr.start_indptr[i + 1]]].tolist()
+            self.nodes[node_name] = node
+        self.cell_list = csr.vocab[csr.cell_list].tolist()
+        self._set_alias_tables(csr.indptr, csr.odds, csr.alias)
+
     def convert_to_nx(self):
         if NX_NOT_FOUND:
             raise ImportError('NetworkX not found.')
         else:
             nxg = nx.Graph()
-            for edge in self.edges:
-                nxg.add_edge(edge.node_from, edge.node_to)
+            for node in self.nodes.values():
+                for neighbor_name in node.neighbor_names:
+                    nxg.add_edge(node.name, neighbor_name)
             return nxg
 
 
@@ -396,7 +446,11 @@ def graph_generation(configuration, edgelist, prefixes, dictionary=None):
                 else:
                     l.append(_)
 
-    g = Graph(edgelist=edgelist, prefixes=prefixes, sim_list=list_sim, flatten=flatten)
+    # The batch strategy draws the walks from the arrays of the csr graph.
+    if configuration.get('graph_engine', 'dict') == 'csr' or configuration['walks_strategy'] == 'batch':
+        g = CSRGraph(edgelist=edgelist, prefixes=prefixes, flatten=flatten)
+    else:
+        g = Graph(edgelist=edgelist, prefixes=prefixes, sim_list=list_sim, flatten=flatten)
     t_end = datetime.datetime.now()
     dt = t_end - t_start
     # print()
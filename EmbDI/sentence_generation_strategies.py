@@ -15,13 +15,30 @@ limitations under the License.
 """
 
 import datetime
+import multiprocessing as mp
 import random
+from concurrent.futures import ProcessPoolExecutor
 
 from tqdm import tqdm
 
+from EmbDI.csr_graph import CSRGraph
 from EmbDI.graph import Node
 from EmbDI.utils import *
 
+# Number of walks generated at once by the batch strategy. The walks are split in shards of this size, each one with
+# its own random stream, so the corpus does not depend on the number of processes that generate them.
+BATCH_SIZE = 65536
+# Largest shard of the batch strategy with a walks budget, which is checked after every shard. Smaller graphs use
+# shards of one walk from each cell, so that the budget stops about as soon as with generate_budgeted_walks.
+BUDGET_BATCH_SIZE = 4096
+
+# Number of walks between two checks of the walks budget, so that large tables stop soon after the budget is exhausted
+# and the walks are not slowed down by the checks.
+BUDGET_CHECK_INTERVAL = 1000
+
+# Arguments of the batch walks, shared with forked processes
+_shared = {}
+
 
 class RandomWalk:
     def __init__(self, graph_nodes, starting_node_name, sentence_len, backtrack, uniform, repl_strings=True,
@@ -117,6 +134,41 @@ class RandomWalk:
             return value.name, value.name
 
 
+class CSRRandomWalk:
+    """Random walk on a CSRGraph. It follows the same steps as RandomWalk, without the replacement strategies."""
+
+    def __init__(self, graph, starting_node, sentence_len, backtrack):
+        first_node = graph.get_random_start(starting_node)
+        if first_node != starting_node:
+            walk = [first_node, starting_node]
+        else:
+            walk = [starting_node]
+        current_node = starting_node
+        sentence_step = len(walk)
+        while sentence_step < sentence_len:
+            next_node = graph.get_weighted_random_neighbor(current_node)
+            if not backtrack and next_node == walk[-1]:
+                continue
+            current_node = next_node
+            if not graph.isappear[current_node]:
+                continue
+            walk.append(current_node)
+            sentence_step += 1
+        self.walk = graph.vocab[walk].tolist()
+
+    def get_walk(self):
+        return self.walk
+
+
+def random_walk(parameters, graph, cell):
+    """Generate one random walk from the given cell, with the walk class that matches the graph."""
+    if isinstance(graph, CSRGraph):
+        return CSRRandomWalk(graph, cell, int(parameters['sentence_length']), parameters['backtrack'])
+    return RandomWalk(graph.nodes, cell, int(parameters['sentence_length']), parameters['backtrack'], graph.uniform,
+                      repl_numbers=parameters['repl_numbers'],
+                      repl_strings=parameters['repl_strings'])
+
+
 def extract_numeric_rep(value, keys_array):
     new_val = np.around(np.random.normal(loc=value, scale=1))
     cc = 0
@@ -134,15 +186,34 @@ def extract_numeric_rep(value, keys_array):
     return str(int(new_val))
 
 
+def split_walk(walk, node_words):
+    """Split a walk into the words that gensim would read from the walks file, where node names that contain
+    spaces are broken into several words. The split of every node is cached in node_words, so that the words are
+    shared by all the walks that visit the node.
+
+    :param walk: list of node names
+    :param node_words: dictionary from node names to their words
+    :return: list of words
+    """
+    words = []
+    for node_name in walk:
+        try:
+            words += node_words[node_name]
+        except KeyError:
+            node_words[node_name] = node_name.split()
+            words += node_words[node_name]
+    return words
+
+
 def generate_walks(parameters, graph, intersection=None):
     sentences = []
+    node_words = {}
     n_sentences = int(float(parameters['n_sentences']))
     strategies = parameters['walks_strategy']
-    sentence_length = int(parameters['sentence_length'])
-    backtrack = parameters['backtrack']
 
     if intersection is None:
-        intersection = set(graph.cell_list)
+        # The cells are visited in the order of the graph rather than of a set, so that seeded runs are reproducible.
+        intersection = graph.cell_list
         n_cells = len(intersection)
     else:
         n_cells = len(intersection)
@@ -153,12 +224,12 @@ def generate_walks(parameters, graph, intersection=None):
     # ########### Random walks ############
     # print('Generating random walks.')
 
-    if parameters.get('walks_file') != None:
-        walks_file = parameters['walks_file']
-    else:
-        walks_file = 'pipeline/walks/' + parameters['output_file'] + '.walks'
-
-    if parameters['write_walks']: fp_walks = open(walks_file, 'w')
+    if parameters['write_walks']:
+        if parameters.get('walks_file') != None:
+            walks_file = parameters['walks_file']
+        else:
+            walks_file = 'pipeline/walks/' + parameters['output_file'] + '.walks'
+        fp_walks = open(walks_file, 'w')
     t2 = datetime.datetime.now()
     str_start_time = t2.strftime(TIME_FORMAT)
     # print(OUTPUT_FORMAT.format('Generating basic random walks.', str_start_time))
@@ -172,9 +243,7 @@ def generate_walks(parameters, graph, intersection=None):
             # if cell in intersection:
             r = []
             for _r in range(random_walks_per_node):
-                w = RandomWalk(graph.nodes, cell, sentence_length, backtrack, graph.uniform,
-                               repl_numbers=parameters['repl_numbers'],
-                               repl_strings=parameters['repl_strings'])
+                w = random_walk(parameters, graph, cell)
 
                 r.append(w.get_walk())
 
@@ -186,7 +255,7 @@ def generate_walks(parameters, graph, intersection=None):
                 else:
                     pass
             else:
-                sentences += r
+                sentences += [split_walk(_, node_words) for _ in r]
             sentence_counter += random_walks_per_node
             count_cells += 1
             # pbar.update(random_walks_per_node)
@@ -203,9 +272,7 @@ def generate_walks(parameters, graph, intersection=None):
         for count_cells in range(needed):
             cell = random.choice(l_int)
             # if cell in intersection:
-            w = RandomWalk(graph.nodes, cell, sentence_length, backtrack, graph.uniform,
-                           repl_numbers=parameters['repl_numbers'],
-                           repl_strings=parameters['repl_strings'])
+            w = random_walk(parameters, graph, cell)
             sen = [w.get_walk()]
 
             for s in sen:
@@ -214,7 +281,7 @@ def generate_walks(parameters, graph, intersection=None):
                     s = ws + '\n'
                     fp_walks.write(s)
                 else:
-                    sentences += s
+                    sentences.append(split_walk(s, node_words))
             sentence_counter += len(sen)
                 # pbar.update(1)
 
@@ -231,6 +298,219 @@ def generate_walks(parameters, graph, intersection=None):
         return sentences
 
 
+def generate_budgeted_walks(parameters, graph, intersection=None):
+    """Generate at most n_sentences random walks, stopping early when the walks have taken too long or when every node
+    has been visited enough times. The walks are generated in rounds with one walk starting from each cell, so that
+    the cells are equally represented, and the budget is checked every BUDGET_CHECK_INTERVAL walks and at the end of
+    every round. The budget is therefore approximate, the walks may exceed it by up to one check interval.
+    generate_batch_walks checks it after every round of up to BUDGET_BATCH_SIZE walks, so that both strategies stop at
+    comparable numbers of walks.
+
+    :param parameters: run parameters, with the optional budget parameters 'walks_time_budget' (seconds) and
+    'walks_min_occurrences' (visits of every node that saturate the coverage of the graph)
+    :param graph: graph to traverse
+    :param intersection: optional list of cells to start from
+    :return: path of the walks file (if write_walks == True), list of walks otherwise
+    """
+    sentences = []
+    node_words = {}
+    n_sentences = int(float(parameters['n_sentences']))
+    time_budget = parameters.get('walks_time_budget')
+    min_occurrences = parameters.get('walks_min_occurrences')
+
+    if intersection is None:
+        intersection = graph.cell_list
+    cells = list(intersection)
+
+    if parameters['write_walks']:
+        if parameters.get('walks_file') != None:
+            walks_file = parameters['walks_file']
+        else:
+            walks_file = 'pipeline/walks/' + parameters['output_file'] + '.walks'
+        fp_walks = open(walks_file, 'w')
+
+    t_start = datetime.datetime.now()
+    occurrences = dict.fromkeys(graph.get_node_list(), 0)
+    unsaturated = len(occurrences) if min_occurrences else None
+    sentence_counter = 0
+
+    def budget_exhausted():
+        if min_occurrences and unsaturated <= 0:
+            return True
+        return bool(time_budget) and (datetime.datetime.now() - t_start).total_seconds() > time_budget
+
+    exhausted = False
+    while sentence_counter < n_sentences and not exhausted:
+        for cell in cells[:n_sentences - sentence_counter]:
+            w = random_walk(parameters, graph, cell)
+            walk = w.get_walk()
+            if parameters['write_walks']:
+                fp_walks.write(' '.join(walk) + '\n')
+            else:
+                sentences.append(split_walk(walk, node_words))
+            sentence_counter += 1
+
+            if min_occurrences:
+                for node_name in walk:
+                    occurrences[node_name] += 1
+                    if occurrences[node_name] == min_occurrences:
+                        unsaturated -= 1
+
+            if sentence_counter % BUDGET_CHECK_INTERVAL == 0 and budget_exhausted():
+                exhausted = True
+                break
+        else:
+            exhausted = budget_exhausted()
+
+    # Record the number of walks actually generated.
+    parameters['n_sentences'] = sentence_counter
+
+    if parameters['write_walks']:
+        fp_walks.close()
+        return walks_file
+    else:
+        return sentences
+
+
+def batch_walks(graph, starting_nodes, sentence_length, backtrack, rng=np.random):
+    """Generate one random walk from each of the starting nodes of a CSRGraph. All walks advance in lockstep, with one
+    vectorized draw per step for the walks that are not complete yet, so that they follow the same distribution as
+    RandomWalk without a Python call per step.
+
+    :param graph: CSRGraph to traverse
+    :param starting_nodes: array of node ids
+    :param sentence_length: number of nodes in each walk
+    :param backtrack: if False, a walk never steps back to the node it has just appended
+    :param rng: source of the random numbers, either numpy.random or a numpy Generator
+    :return: matrix of node ids with one walk per row
+    """
+    n_walks = len(starting_nodes)
+    walks = np.empty((n_walks, sentence_length), dtype=np.int32)
+    first = graph.random_starts(starting_nodes, rng)
+    has_first = first != starting_nodes
+    walks[:, 0] = first
+    walks[has_first, 1] = starting_nodes[has_first]
+    position = np.where(has_first, 2, 1)
+    current = starting_nodes.copy()
+    last = starting_nodes.copy()
+
+    active = np.flatnonzero(position < sentence_length)
+    while len(active) > 0:
+        next_nodes = graph.weighted_random_neighbors(current[active], rng)
+        if not backtrack:
+            # Rejected steps are drawn again from the same node.
+            moved = next_nodes != last[active]
+            active, next_nodes = active[moved], next_nodes[moved]
+        current[active] = next_nodes
+        appear = graph.isappear[next_nodes]
+        active, next_nodes = active[appear], next_nodes[appear]
+        walks[active, position[active]] = next_nodes
+        last[active] = next_nodes
+        position[active] += 1
+        active = np.flatnonzero(position < sentence_length)
+    return walks
+
+
+def walk_shard(shard):
+    """Generate the walks of a shard of the starting nodes with the random stream of the shard."""
+    graph, starting_nodes, sentence_length, backtrack, seed, batch_size = _shared['batch']
+    rng = np.random.default_rng([seed, shard])
+    return batch_walks(graph, starting_nodes[shard * batch_size:(shard + 1) * batch_size], sentence_length,
+                       backtrack, rng)
+
+
+def generate_batch_walks(parameters, graph, intersection=None):
+    """Generate the random walks of the 'batch' strategy. The walks start from the same cells as generate_walks,
+    n_sentences // n_cells from each cell followed by the remaining ones from random cells. They are generated by
+    batch_walks in shards of BATCH_SIZE walks, which are spread over 'walks_workers' processes and merged in order.
+    Node ids are converted to words only at output.
+
+    With the same 'walks_seed' the walks are identical for any number of processes. If there is no seed, it is drawn
+    from numpy.random.
+
+    With the budget parameters of generate_budgeted_walks, the walks cycle through the cells instead, so that the
+    cells are equally represented wherever the generation stops, and the budget is checked after every shard of one
+    walk from each cell, or of BUDGET_BATCH_SIZE walks on larger graphs.
+
+    :param parameters: run parameters
+    :param graph: CSRGraph to traverse
+    :param intersection: optional list of node ids of the cells to start from
+    :return: path of the walks file (if write_walks == True), list of walks otherwise
+    """
+    sentences = []
+    n_sentences = int(float(parameters['n_sentences']))
+    sentence_length = int(parameters['sentence_length'])
+    backtrack = parameters['backtrack']
+    seed = parameters.get('walks_seed')
+    if seed is None:
+        seed = np.random.randint(np.iinfo(np.int32).max)
+    time_budget = parameters.get('walks_time_budget')
+    min_occurrences = parameters.get('walks_min_occurrences')
+
+    if intersection is None:
+        intersection = graph.cell_list
+    cells = np.array(intersection, dtype=np.int32)
+    random_walks_per_node = n_sentences // len(cells)
+    needed = n_sentences - random_walks_per_node * len(cells)
+    if time_budget or min_occurrences:
+        repeated_cells = np.tile(cells, random_walks_per_node)
+        batch_size = min(BUDGET_BATCH_SIZE, len(cells))
+    else:
+        repeated_cells = np.repeat(cells, random_walks_per_node)
+        batch_size = BATCH_SIZE
+    starting_nodes = np.concatenate([repeated_cells,
+                                     cells[np.random.default_rng([seed]).integers(len(cells), size=needed)]])
+
+    if parameters['write_walks']:
+        if parameters.get('walks_file') != None:
+            walks_file = parameters['walks_file']
+        else:
+            walks_file = 'pipeline/walks/' + parameters['output_file'] + '.walks'
+        fp_walks = open(walks_file, 'w')
+    node_words = [node_name.split() for node_name in graph.get_node_list()]
+
+    n_shards = -(-n_sentences // batch_size)
+    workers = min(int(parameters.get('walks_workers', 1)), n_shards)
+    _shared['batch'] = (graph, starting_nodes, sentence_length, backtrack, seed, batch_size)
+    t_start = datetime.datetime.now()
+    occurrences = np.zeros(len(node_words), dtype=np.int64)
+    sentence_counter = 0
+    try:
+        if workers > 1:
+            # The processes are forked, so they share the graph with this process instead of receiving a copy.
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('fork'))
+            shards = executor.map(walk_shard, range(n_shards))
+        else:
+            executor = None
+            shards = map(walk_shard, range(n_shards))
+        for walks in shards:
+            if parameters['write_walks']:
+                fp_walks.write(''.join(' '.join(graph.vocab[walk]) + '\n' for walk in walks))
+            else:
+                sentences += [[word for node in walk for word in node_words[node]] for walk in walks.tolist()]
+            sentence_counter += len(walks)
+
+            if min_occurrences:
+                occurrences += np.bincount(walks.ravel(), minlength=len(occurrences))
+                if (occurrences >= min_occurrences).all():
+                    break
+            if time_budget and (datetime.datetime.now() - t_start).total_seconds() > time_budget:
+                break
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        del _shared['batch']
+
+    # Record the number of walks actually generated.
+    parameters['n_sentences'] = sentence_counter
+
+    if parameters['write_walks']:
+        fp_walks.close()
+        return walks_file
+    else:
+        return sentences
+
+
 def split_remaining_sentences(freq_row, freq_col):
     if freq_row == freq_col == 0:
         return [0, 0]
@@ -275,7 +555,12 @@ def random_walks_generation(configuration, graph):
     # intersection = None
 
     # Generating walks.
-    walks = generate_walks(configuration, graph, intersection=intersection)
+    if configuration['walks_strategy'] == 'batch':
+        walks = generate_batch_walks(configuration, graph, intersection=intersection)
+    elif configuration.get('walks_time_budget') or configuration.get('walks_min_occurrences'):
+        walks = generate_budgeted_walks(configuration, graph, intersection=intersection)
+    else:
+        walks = generate_walks(configuration, graph, intersection=intersection)
     t2 = datetime.datetime.now()
     dt = t2 - t1
 
@@ -14,7 +14,9 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import itertools
 import os
+import re
 import string
 import warnings
 
@@ -22,6 +24,7 @@ import numpy as np
 import pandas as pd
 from sklearn.decomposition import PCA
 
+from EmbDI.edgelist import EdgeTable, is_binary_edgelist
 from EmbDI.logging import *
 
 
@@ -182,21 +185,38 @@ def int2base(x, base):
     return ''.join(digits)
 
 
+def ints2base(x, base):
+    """
+    Convert every integer of the array x in base 10 to base 'base', as int2base does for a single integer
+    :param x: array of integers
+    :param base:
+    :return: object array with base(x) for every x
+    """
+    x = np.asarray(x, dtype=np.int64)
+    digits = np.array(list(digs[:base]), dtype=object)
+    values = np.abs(x)
+    converted = digits[values % base]
+    values //= base
+    while values.any():
+        nonzero = values > 0
+        converted[nonzero] = digits[values[nonzero] % base] + converted[nonzero]
+        values //= base
+    converted[x < 0] = '-' + converted[x < 0]
+    return converted
+
+
 def dict_compression_edgelist(edgelist, prefixes):
-    uniques = sorted(list(set(edgelist.values.ravel().tolist())))
+    # Every distinct value is compressed once, then the columns are mapped to the compressed values.
+    uniques = pd.unique(edgelist.values.ravel())
 
     # Expanding strings that contain '_'
     prefixes = [_[4:] for _ in prefixes]
     listed_uniques = {_ for l in uniques for idx, _ in enumerate(l.split('_')) if idx > 0 and _ != ''}
-    uniques = sorted(list(listed_uniques))
-
-    # Removing null values from the compression.
-    if '' in uniques: uniques.remove('')
-    if np.nan in uniques: uniques.remove(np.nan)
+    uniques_split = sorted(list(listed_uniques))
 
     # Generating the keys in base 36.
-    keys = ['@{}'.format(int2base(_, len(digs))) for _ in range(len(uniques))]
-    dictionary = dict(zip(uniques, keys))
+    keys = '@' + ints2base(np.arange(len(uniques_split)), len(digs))
+    dictionary = dict(zip(uniques_split, keys.tolist()))
 
     # Replacing word by word according to the dictionary.
     def replace(line, dictionary, prefixes):
@@ -208,8 +228,9 @@ def dict_compression_edgelist(edgelist, prefixes):
                 s.append(dictionary[val])
         return '_'.join(s)
 
+    compressed = {val: replace(val, dictionary, prefixes) for val in uniques}
     for col in edgelist.columns:
-        edgelist[col] = edgelist[col].apply(replace, dictionary=dictionary, prefixes=prefixes)
+        edgelist[col] = edgelist[col].map(compressed)
     return edgelist, {v: k for k, v in dictionary.items()}
 
 
@@ -222,11 +243,63 @@ def dict_decompression_flatten(df, dictionary):
         return '_'.join(s)
 
     d = dict(zip(dictionary.values(), dictionary.keys()))
+    decompressed = {val: replace(val, d) for val in pd.unique(df.values.ravel())}
     for col in df.columns:
-        df[col] = df[col].apply(replace, dictionary=d)
+        df[col] = df[col].map(decompressed)
     return df, d
 
 
+def intern_node_names(names):
+    """
+    Replace the words in the names of the nodes with short keys, '@' followed by the id of the word in base 36, to cut
+    the memory of the graph, the walks and the vocabulary of the embeddings. The first word of every name (tt__,
+    idx__3, cid__0), spaces and underscores are kept, so that the graph and the walks keep the same structure.
+    :param names: list of node names
+    :return: the list of interned names and the dictionary, an object array with the word of every key id
+    """
+    # Split the rest of the names in words and separators, words are at the even positions.
+    split = re.compile(r'([\s_]+)').split
+    heads = [name.partition(' ') for name in names]
+    pieces = [split(rest) for _, _, rest in heads]
+    lengths = np.array([len(p) for p in pieces], dtype=np.int64)
+    ends = np.cumsum(lengths)
+    pieces = np.array(list(itertools.chain.from_iterable(pieces)), dtype=object)
+    positions = np.arange(len(pieces)) - np.repeat(ends - lengths, lengths)
+    is_word = (positions % 2 == 0) & (pieces != '')
+
+    # Replace the words with their keys, in order of appearance.
+    codes, dictionary = pd.factorize(pieces[is_word])
+    pieces[is_word] = '@' + ints2base(codes, len(digs))
+
+    pieces = pieces.tolist()
+    ends = ends.tolist()
+    interned = [head + sep + ''.join(pieces[start:end])
+                for (head, sep, _), start, end in zip(heads, [0] + ends[:-1], ends)]
+    return interned, np.asarray(dictionary, dtype=object)
+
+
+def decode_words(words, dictionary):
+    """
+    Replace the keys in words interned by intern_node_names with the words in the dictionary. Words that are a single
+    key are decoded with an array lookup, the few words that hold keys along with other characters are decoded key by
+    key.
+    :param words: list of words
+    :param dictionary: object array with the word of every key id
+    :return: the list of decoded words
+    """
+    words = pd.Series(words, dtype=object)
+    keys = pd.Index('@' + ints2base(np.arange(len(dictionary)), len(digs)))
+    ids = keys.get_indexer(words)
+    found = ids >= 0
+    compound = ~found & words.str.contains('@', regex=False).to_numpy()
+
+    decoded = np.array(words, dtype=object)
+    decoded[found] = dictionary[ids[found]]
+    decoded[compound] = words[compound].str.replace(r'@[0-9A-Z]+', lambda m: dictionary[keys.get_loc(m.group(0))],
+                                                    regex=True)
+    return decoded.tolist()
+
+
 def clean_embeddings_file(embeddings_file, dictionary):
     emb_path, ext = os.path.splitext(embeddings_file)
     with open(emb_path + ext, 'r') as fp:
@@ -283,6 +356,7 @@ def return_default_values(config):
         'compression': False,
         'n_sentences': 'default',
         'walks_strategy': 'basic',
+        'graph_engine': 'dict',
         'learning_method': 'skipgram',
         'sentence_length': 60,
         'window_size': 5,
@@ -317,6 +391,11 @@ def _convert_to_bool(config, key):
 
 
 def read_edgelist(edgelist_path):
+    # Binary edgelists are loaded as an EdgeTable, which the graphs are built from directly.
+    if is_binary_edgelist(edgelist_path):
+        edge_table = EdgeTable.load(edgelist_path)
+        return edge_table.prefixes, edge_table
+
     with open(edgelist_path, 'r') as fp:
         edgelist = []
         for idx, line in enumerate(fp):
@@ -413,8 +492,12 @@ def check_config_validity(config):
     if not 1 > config['sampling_factor'] >= 0:
         raise ValueError('Sampling factor must be in [0,1).')
 
-    if config['walks_strategy'] not in ['basic', 'replacement']:
+    if config['walks_strategy'] not in ['basic', 'replacement', 'batch']:
         raise ValueError('Unknown walks strategy {}.'.format(config['walks_strategy']))
+    if config['graph_engine'] not in ['dict', 'csr']:
+        raise ValueError('Unknown graph engine {}.'.format(config['graph_engine']))
+    if config['graph_engine'] == 'csr' and config['walks_strategy'] == 'replacement':
+        raise ValueError('The csr graph engine does not support the replacement strategy.')
     if config['numeric'] not in ['no', 'only', 'all']:
         raise ValueError('Unknown numeric strategy {}.'.format(config['numeric']))
     if config['training_algorithm'] not in ['word2vec', 'fasttext']:
@@ -431,6 +514,8 @@ def check_config_validity(config):
         'repl_numbers'
     ]:
         config = _convert_to_bool(config, key)
+    if config['compression'] and config['training_algorithm'] == 'fasttext':
+        raise ValueError('Compression cannot be used with fasttext, which learns from the characters of the words.')
 
     if 'epsilon' in config:
         try:
@@ -473,7 +558,7 @@ def check_config_validity(config):
         warnings.warn('Number of dimensions different from default (300): {}'.format(config['n_dimensions']))
     if int(config['window_size']) != 5:
         warnings.warn('Window size different from default (5): {}'.format(config['window_size']))
-    if config['walks_strategy'] == 'basic' and config['numeric'] != 'no':
+    if config['walks_strategy'] in ['basic', 'batch'] and config['numeric'] != 'no':
         config['numeric'] = 'no'
         warnings.warn('Basic random walks require no replacement strategy.')
 
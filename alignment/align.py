@@ -58,7 +58,7 @@ def proj_spectral(R):
     s[s < 0] = 0
     return np.dot(U, np.dot(np.diag(s), V))
 
-def align_embeddings(x_src, x_tgt, pairs, src2tgt=None, knn=10, maxneg=200000, model=None, reg=0.0 , lr=1.0, niter=10, sgd=False, batchsize=10000):
+def align_embeddings(x_src, x_tgt, pairs, src2tgt=None, knn=10, maxneg=200000, model=None, reg=0.0 , lr=1.0, niter=10, sgd=False, batchsize=10000, init=None):
     # selecting training vector  pairs
     X_src, Y_tgt = select_vectors_from_pairs(x_src, x_tgt, pairs)
 
@@ -66,8 +66,12 @@ def align_embeddings(x_src, x_tgt, pairs, src2tgt=None, knn=10, maxneg=200000, m
     Z_src = x_src[:maxneg, :]
     Z_tgt = x_tgt[:maxneg, :]
 
-    # initialization:
-    R = procrustes(X_src, Y_tgt)
+    # initialization: Procrustes, unless an initial mapping is given (e.g. the
+    # identity for table embeddings that were trained from the source vectors)
+    if init is None:
+        R = procrustes(X_src, Y_tgt)
+    else:
+        R = np.array(init, dtype=X_src.dtype)
     if src2tgt != None:
         nnacc = compute_nn_accuracy(np.dot(x_src, R.T), x_tgt, src2tgt, lexicon_size=lexicon_size)
         print("[init -- Procrustes] NN: %.4f"%(nnacc))
@@ -3,7 +3,6 @@ from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
-from gensim.models import KeyedVectors
 import os
 import json
 import random
@@ -12,7 +11,8 @@ import nltk
 import sys
 
 sys.path.insert(1, '../')
-from util import get_row_matches, get_col_matches, add_aligned_vectors, wikisql_table_to_df
+from util import get_row_matches, get_col_matches, add_aligned_vectors, wikisql_table_to_df, load_embeddings
+from util import read_embeddings, OUTPUT_FORMATS
 
 
 SLEMB_DIR = "./slemb"
@@ -26,20 +26,25 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 
 templates = Jinja2Templates(directory="templates")
 
-#Load pre-trained word embeddings
-kv_pre = KeyedVectors.load_word2vec_format(EMB_FILE)
+#Load pre-trained word embeddings, from the store created by convert_embeddings.py if there is one
+emb_store = os.path.splitext(EMB_FILE)[0] + ".kv"
+kv_pre = load_embeddings(emb_store if os.path.isfile(emb_store) else EMB_FILE)
 vec_pre = kv_pre.vectors
 words_pre_set = set(kv_pre.key_to_index.keys())
 idx_pre = kv_pre.key_to_index
 
-#Load available table id embeddings
+#Load available table id embeddings, in any output format of main.py
 files = os.listdir(SLEMB_DIR)
 table_ids = set()
+emb_files = {}
 for file_name in files:
-    if os.path.isfile(os.path.join(SLEMB_DIR, file_name)):
-        file_name = file_name.rstrip(".emb")
-        file_name = file_name.rstrip(".R.npy")
-        table_ids.add(file_name)
+    if os.path.isfile(os.path.join(SLEMB_DIR, file_name)) and file_name.endswith(".R.npy"):
+        table_ids.add(file_name[:-len(".R.npy")])
+for table_id in table_ids:
+    for ext in OUTPUT_FORMATS.values():
+        if ext and os.path.isfile(os.path.join(SLEMB_DIR, f"{table_id}{ext}")):
+            emb_files[table_id] = os.path.join(SLEMB_DIR, f"{table_id}{ext}")
+table_ids = set(emb_files)
 
 #Load tables
 tables = {}
@@ -62,7 +67,7 @@ async def root_post(request: Request, query: str = Form(...)):
     #Load table
     tdf = wikisql_table_to_df(tables[current_id])
     #Load table embeddings and R matrix
-    kv_tab = KeyedVectors.load_word2vec_format(os.path.join(SLEMB_DIR, f"{current_id}.emb"))
+    kv_tab = read_embeddings(emb_files[current_id])
     R = np.load(os.path.join(SLEMB_DIR, f"{current_id}.R.npy"))
     #Tokenize NLQ
     tokens = nltk.word_tokenize(query)
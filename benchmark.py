@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import string
+import tempfile
+
+import numpy as np
+
+from alignment.align import align_embeddings
+from util import create_table_emb, wikisql_table_to_df, stage_timer, CONFIGURATION
+
+#Synthetic table shapes: number of rows and columns, maximum number of words
+#per text cell and number of numeric columns
+SHAPES = {
+    'tiny': {'rows': 10, 'cols': 4, 'words': 1, 'numeric': 1},
+    'small': {'rows': 50, 'cols': 6, 'words': 2, 'numeric': 2},
+    'text': {'rows': 30, 'cols': 6, 'words': 6, 'numeric': 0},
+    'numeric': {'rows': 200, 'cols': 6, 'words': 1, 'numeric': 5},
+    'wide': {'rows': 50, 'cols': 16, 'words': 2, 'numeric': 4},
+    'long': {'rows': 1000, 'cols': 4, 'words': 1, 'numeric': 2},
+}
+
+#Measured stages and the counter that each throughput is reported for
+STAGES = [
+    ('edgelist', 'n_rows', 'rows/s'),
+    ('graph', 'n_edges', 'edges/s'),
+    ('walks', 'n_walks', 'walks/s'),
+    ('training', 'n_words', 'words/s'),
+    ('alignment', 'n_anchors', 'anchors/s'),
+]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("-s", "--shapes", nargs='+', choices=list(SHAPES), default=list(SHAPES), help="Table shapes to benchmark")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of runs per shape, the median time is reported")
+    parser.add_argument("-d", "--embeddings_dimension", type=int, default=100, help="Dimension of the embeddings")
+    parser.add_argument("-a", "--embeddings_algorithm", choices=['word2vec', 'fasttext'], default='word2vec', help="Algorithm to use for training local embeddings")
+    parser.add_argument("-p", "--pretrained_size", type=int, default=50000, help="Number of synthetic pre-trained vectors used for the alignment")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of threads used for training")
+    parser.add_argument("--walks_strategy", choices=['basic', 'batch'], default=CONFIGURATION['walks_strategy'], help="Random walk generation, 'batch' generates the walks of a table in vectorized batches, spread over the threads of the table")
+    parser.add_argument("--graph_engine", choices=['dict', 'csr'], default=CONFIGURATION['graph_engine'], help="Representation of the table graphs, 'csr' keeps them in integer arrays and is lighter on large tables")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic data and the embeddings")
+    parser.add_argument("--save", help="JSON file to save the results, to be used as a baseline later")
+    parser.add_argument("--baseline", help="JSON file with the results of an earlier run to compare against")
+
+    return(parser.parse_args())
+
+
+def make_vocabulary(size, rng):
+    return [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 10))) for _ in range(size)]
+
+
+def make_table(shape, vocabulary, rng):
+    """
+    Generate a WikiSQL-style table of the given shape, with multi-word text
+    columns followed by integer and decimal numeric columns
+    """
+    n_text = shape['cols'] - shape['numeric']
+    header = [' '.join(rng.sample(vocabulary, 2)) for _ in range(shape['cols'])]
+    rows = []
+    for _ in range(shape['rows']):
+        row = [' '.join(rng.choice(vocabulary) for _ in range(rng.randint(1, shape['words'])))
+               for _ in range(n_text)]
+        row += [rng.randint(0, 1000) if c % 2 == 0 else round(rng.uniform(0, 100), 1)
+                for c in range(shape['numeric'])]
+        rows.append(row)
+    return {'id': f"bench-{shape['rows']}x{shape['cols']}", 'header': header, 'rows': rows}
+
+
+def run_shape(shape, vocabulary, vec_pre, idx_pre, temp_dir, args):
+    """
+    Embed and align a synthetic table and return the measurements of the run
+    """
+    rng = random.Random(args.seed)
+    table = make_table(shape, vocabulary, rng)
+    tdf = wikisql_table_to_df(table)
+
+    stats = {'n_rows': tdf.shape[0]}
+    emb_file = os.path.join(temp_dir, "bench.emb")
+    model = create_table_emb(tdf, emb_file, args.embeddings_algorithm, args.embeddings_dimension,
+                             workers=args.workers, seed=args.seed, stats=stats,
+                             configuration={'walks_strategy': args.walks_strategy, 'graph_engine': args.graph_engine})
+
+    kv_tab = model.wv
+    pairs = [(idx_pre[w], kv_tab.key_to_index[w]) for w in kv_tab.key_to_index if w in idx_pre]
+    stats['n_anchors'] = len(pairs)
+    with stage_timer(stats, 'alignment'):
+        align_embeddings(vec_pre, kv_tab.vectors, pairs)
+    return stats
+
+
+def summarize(runs):
+    """
+    Reduce the measurements of repeated runs to the median wall time and the
+    throughput of every stage
+    """
+    result = {}
+    for stage, counter, unit in STAGES:
+        wall_time = statistics.median(run[stage]['wall_time'] for run in runs)
+        result[stage] = {
+            'wall_time': wall_time,
+            'cpu_time': statistics.median(run[stage]['cpu_time'] for run in runs),
+            'throughput': runs[0][counter] / wall_time if wall_time > 0 else float('inf'),
+            'unit': unit,
+        }
+    result['peak_rss_mb'] = max(run[stage]['peak_rss_mb'] for run in runs for stage, _, _ in STAGES)
+    return result
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    #Synthetic pre-trained vectors that cover the vocabulary of the tables
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(1000, rng)
+    words_pre = vocabulary + [f"filler{i}" for i in range(max(0, args.pretrained_size - len(vocabulary)))]
+    vec_pre = np.random.default_rng(args.seed).standard_normal((len(words_pre), args.embeddings_dimension)).astype(np.float32)
+    idx_pre = {w: i for i, w in enumerate(words_pre)}
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    results = {}
+    for name in args.shapes:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            runs = [run_shape(SHAPES[name], vocabulary, vec_pre, idx_pre, temp_dir, args) for _ in range(args.repeat)]
+        results[name] = summarize(runs)
+
+        print(f"{name} {SHAPES[name]} peak RSS {results[name]['peak_rss_mb']:.0f} MB")
+        for stage, _, unit in STAGES:
+            res = results[name][stage]
+            line = f"  {stage:<10} {res['wall_time']:9.4f} s {res['throughput']:14.1f} {unit}"
+            if baseline and name in baseline:
+                base = baseline[name][stage]
+                line += f"   x{base['wall_time'] / res['wall_time']:.2f} vs baseline"
+            print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'args': vars(args), **results}, f, indent=2)
@@ -0,0 +1,20 @@
+import argparse
+
+from util import convert_embeddings
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("-i", "--input_file", required=True, help="Input pre-trained embeddings file in word2vec format (.vec, .txt or .bin)")
+    parser.add_argument("-o", "--output_file", required=True, help="Output .kv file, the vectors are saved next to it in a .npy file")
+
+    return(parser.parse_args())
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if not args.output_file.endswith('.kv'):
+        raise ValueError(f"Output file {args.output_file} must have the .kv extension")
+
+    convert_embeddings(args.input_file, args.output_file)
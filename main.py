@@ -3,82 +3,376 @@ import argparse
 import random
 import os
 import sys
+import shutil
+import traceback
+import multiprocessing as mp
+import itertools
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
 import pandas as pd
 import numpy as np
-from gensim.models import KeyedVectors
 from tqdm.auto import tqdm
 
 from alignment.utils import load_vectors, idx, select_vectors_from_pairs
 from alignment.align import align_embeddings
 
-from util import create_table_emb, wikisql_table_to_df
+from util import create_table_embs, wikisql_table_to_df, load_embeddings, stage_timer, CPUBudget, CONFIGURATION
+from util import embeddings_files, cache_path, atomic_file, OUTPUT_FORMATS
+from util import table_digest, dataframe_digest, params_digest, load_manifest, write_manifest, append_manifest
 
 TEMP_DIR = "./tmp/"
+MANIFEST_FILE = "manifest.jsonl"
+#Subdirectory of the cache directory for the graphs and random walks
+WALKS_CACHE_DIR = "walks"
+
+#State of the current process, filled in by init_worker
+worker = {}
 
 def parse_args():
     parser = argparse.ArgumentParser(description=__doc__,
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
 
     parser.add_argument("-t", "--tables_file", required=True, help="Input WikiSQL .tables.jsonl file")
-    parser.add_argument("-e", "--embeddings_file", required=True, help="Pre-trained embeddings file")
-    parser.add_argument("-d", "--embeddings_dimension", type=int, required=True, help="Dimension of pre-trained embeddings")
-    parser.add_argument("-a", "--embeddings_algorithm", choices=['word2vec', 'fasttext'], required=True, help="Algorithm to use for training local embeddings")
-    parser.add_argument("-o", "--output_dir", required=True, help="Output directory to save the table embeddings and alignment matrices")
+    parser.add_argument("-e", "--embeddings_file", nargs='+', required=True, help="Pre-trained embeddings file, either in word2vec format or a .kv store created with convert_embeddings.py, or one file for every dimension of -d, in the same order")
+    parser.add_argument("-d", "--embeddings_dimension", type=int, nargs='+', required=True, help="Dimension of pre-trained embeddings, several dimensions train a configuration for each one")
+    parser.add_argument("-a", "--embeddings_algorithm", choices=['word2vec', 'fasttext'], nargs='+', required=True, help="Algorithm to use for training local embeddings, several algorithms train a configuration for each one")
+    parser.add_argument("-o", "--output_dir", required=True, help="Output directory to save the table embeddings and alignment matrices, with a subdirectory per configuration when several are trained")
+    parser.add_argument("--output_format", choices=list(OUTPUT_FORMATS), default='text', help="Format of the table embeddings, 'text' is the word2vec text format, 'gensim' the native gensim format, 'npy' a float32 matrix with the vocabulary in a .vocab file, and 'none' only saves the alignment matrices")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of tables to embed in parallel, each one in a separate process")
+    parser.add_argument("--write_temp", action='store_true', help="Write the edgelist and random walks of each table in the temporary directory, for debugging")
+    parser.add_argument("--walks_strategy", choices=['basic', 'batch'], default=CONFIGURATION['walks_strategy'], help="Random walk generation, 'batch' generates the walks of a table in vectorized batches, spread over the threads of the table")
+    parser.add_argument("--graph_engine", choices=['dict', 'csr'], default=CONFIGURATION['graph_engine'], help="Representation of the table graphs, 'csr' keeps them in integer arrays and is lighter on large tables")
+    parser.add_argument("--compression", action='store_true', help="Replace the words of the table graphs and random walks with short keys, which cuts their memory on large tables (word2vec only, not with --write_temp)")
+    parser.add_argument("--warm_start", action='store_true', help="Start the training of the table embeddings from the pre-trained vectors of their words, and align them starting from the identity")
+    parser.add_argument("--warm_epochs", type=int, default=2, help="Number of training epochs with --warm_start")
+    parser.add_argument("--token_budget", type=int, help="Maximum number of words in the random walks of a table")
+    parser.add_argument("--time_budget", type=float, help="Maximum number of seconds spent generating the random walks of a table")
+    parser.add_argument("--min_occurrences", type=int, help="Stop generating random walks for a table once every node has been visited this many times")
+    parser.add_argument("--stats_file", help="JSONL file to append the timing, memory and size measurements of every table")
+    parser.add_argument("--cache_dir", help="Directory to cache the table embeddings and alignment matrices by table contents, so that duplicate tables are built once, and the random walks of tables, so that runs with other training parameters skip straight to training")
+
+    args = parser.parse_args()
+    if len(args.embeddings_file) not in (1, len(args.embeddings_dimension)):
+        parser.error("-e takes a single file or one file for every dimension of -d")
+    if args.compression and 'fasttext' in args.embeddings_algorithm:
+        parser.error("--compression cannot be used with fasttext, which learns from the characters of the words")
+    if args.compression and args.write_temp:
+        parser.error("--compression cannot be used with --write_temp, which writes the edgelist and walks with their words")
+    return(args)
+
+
+def init_worker(args, kvs_pre, cpu_budget):
+    """
+    Prepare the state of a process that embeds tables. Every process gets its
+    own temporary directory, so that auxiliary files of concurrent tables do
+    not overwrite each other, and takes the threads of every table from the
+    CPU budget shared by all processes. The pre-trained embeddings are given
+    by file.
+    """
+    temp_dir = os.path.join(TEMP_DIR, f"worker-{os.getpid()}")
+    if args.write_temp:
+        os.makedirs(temp_dir, exist_ok=True)
+
+    worker['args'] = args
+    worker['kvs_pre'] = kvs_pre
+    worker['words_pre_sets'] = {f: set(kv_pre.key_to_index.keys()) for f, kv_pre in kvs_pre.items()}
+    worker['temp_dir'] = temp_dir
+    worker['cpu_budget'] = cpu_budget
+    worker['configs'] = build_configs(args)
+    worker['configuration'] = build_configuration(args)
+
+
+def build_configs(args):
+    """
+    Return the training configurations, one for every combination of the
+    algorithms and dimensions in the arguments. The walks of a table are
+    generated once and shared by all of its configurations. A single
+    configuration writes directly in the output directory, several write in
+    a subdirectory each.
+    """
+    configs = []
+    for algorithm, dimension in itertools.product(args.embeddings_algorithm, args.embeddings_dimension):
+        name = f"{algorithm}-{dimension}"
+        embeddings_file = pretrained_file(args, dimension)
+        configs.append({
+            'name': name,
+            'algorithm': algorithm,
+            'dimension': dimension,
+            'embeddings_file': embeddings_file,
+            'params': build_params(args, algorithm, dimension, embeddings_file),
+            'output_dir': os.path.join(args.output_dir, name),
+        })
+    if len(configs) == 1:
+        configs[0]['output_dir'] = args.output_dir
+    return configs
+
+
+def pretrained_file(args, dimension):
+    #A single pre-trained file is used for every dimension, otherwise there is
+    #one for every dimension
+    if len(args.embeddings_file) == 1:
+        return args.embeddings_file[0]
+    return args.embeddings_file[args.embeddings_dimension.index(dimension)]
+
+
+def build_params(args, algorithm, dimension, embeddings_file):
+    """
+    Return the parameters that the table embeddings and alignment matrices
+    depend on. Tables built with different parameters are rebuilt.
+    """
+    params = {
+        'embeddings_file': os.path.abspath(embeddings_file),
+        'embeddings_dimension': dimension,
+        'embeddings_algorithm': algorithm,
+        'configuration': build_configuration(args),
+    }
+    #The text format is left out, so that the manifests and caches of earlier
+    #runs stay valid
+    if args.output_format != 'text':
+        params['output_format'] = args.output_format
+    if args.warm_start:
+        params['warm_epochs'] = args.warm_epochs
+    return params
+
+
+def manifest_params(configs):
+    #A single configuration keeps the parameters of a single run, so that
+    #the manifests of earlier runs stay valid
+    if len(configs) == 1:
+        return configs[0]['params']
+    return [config['params'] for config in configs]
+
+
+def build_configuration(args):
+    """
+    Return the EmbDI configuration for the tables, with the walks strategy,
+    graph engine and walk budget given in the arguments
+    """
+    return dict(CONFIGURATION,
+                walks_strategy=args.walks_strategy,
+                graph_engine=args.graph_engine,
+                compression=args.compression,
+                walks_token_budget=args.token_budget,
+                walks_time_budget=args.time_budget,
+                walks_min_occurrences=args.min_occurrences)
+
+
+def output_files(output_dir, table_id, output_format):
+    #File to save new table embeddings, followed by any auxiliary files of the
+    #output format
+    emb_out_file = os.path.join(output_dir, f"{table_id}{OUTPUT_FORMATS[output_format]}")
+    #File to save alignment matrix
+    matrix_out_file = os.path.join(output_dir, f"{table_id}.R.npy")
+    return emb_out_file, embeddings_files(emb_out_file, output_format) + [matrix_out_file]
+
+
+def cache_files(cache_dir, key, output_format):
+    return output_files(os.path.dirname(cache_path(cache_dir, key)), key, output_format)[1]
+
+
+def copy_files(src_files, dst_files):
+    #Copy each source file to the corresponding destination, see atomic_file
+    for src, dst in zip(src_files, dst_files):
+        with atomic_file(dst) as tmp:
+            shutil.copyfile(src, tmp)
 
-    return(parser.parse_args())
+
+def read_tables(tables_file):
+    """
+    Stream the lines of the tables file. Yields the line, id and digest of
+    each table.
+    """
+    with open(tables_file, 'r') as f:
+        for line in f:
+            table = json.loads(line)
+            yield line, table['id'], table_digest(table)
+
+
+def is_complete(manifest, table_id, digest, configs, output_format):
+    """
+    Check if a table is recorded in the manifest with the same contents and
+    parameters, and the output files of every configuration still exist
+    """
+    record = manifest.get(table_id)
+    if record is None or record['input'] != digest or record['params'] != manifest_params(configs):
+        return False
+    return all(os.path.isfile(x) for config in configs
+               for x in output_files(config['output_dir'], table_id, output_format)[1])
+
+
+def embed_table(line):
+    """
+    Create the embeddings and the alignment matrices of the table in the
+    given line of the tables file, for every configuration. Returns the
+    measurements of the table, one dictionary per configuration.
+    """
+    args = worker['args']
+    kvs_pre = worker['kvs_pre']
+    configs = worker['configs']
+
+    #Load table
+    table = json.loads(line)
+    table_id = table['id']
+    tdf = wikisql_table_to_df(table)
+    stats = {'id': table_id, 'n_rows': tdf.shape[0], 'n_cols': tdf.shape[1]}
+    config_stats = [{'config': config['name'], 'cached': False} for config in configs]
+
+    #Tables with the same contents and parameters share the same key. The seed
+    #only depends on the contents and the EmbDI configuration, so that runs
+    #with other training parameters can reuse the cached random walks
+    digest = dataframe_digest(tdf)
+    keys = [params_digest({'table': digest, 'params': config['params']}) for config in configs]
+    seed = int(params_digest({'table': digest, 'configuration': worker['configuration']})[:8], 16)
+
+    #Reuse the files of a duplicate table built earlier
+    missing = []
+    for config, key, cstats in zip(configs, keys, config_stats):
+        emb_out_file, out_files = output_files(config['output_dir'], table_id, args.output_format)
+        if args.cache_dir:
+            cached = cache_files(args.cache_dir, key, args.output_format)
+            if all(os.path.isfile(x) for x in cached):
+                copy_files(cached, out_files)
+                cstats['cached'] = True
+                continue
+        missing.append((config, key, cstats, emb_out_file, out_files))
+
+    #Create table embeddings, the walks are generated once for all configurations
+    if missing:
+        models = create_table_embs(tdf, [(emb_out_file, config['algorithm'], config['dimension'])
+                                         for config, _, _, emb_out_file, _ in missing],
+                                   worker['temp_dir'], write_files=args.write_temp,
+                                   seed=seed, stats=stats, configuration=worker['configuration'],
+                                   cache_dir=os.path.join(args.cache_dir, WALKS_CACHE_DIR) if args.cache_dir else None,
+                                   config_stats=[cstats for _, _, cstats, _, _ in missing],
+                                   cpu_budget=worker['cpu_budget'], output_format=args.output_format,
+                                   init_vectors=[kvs_pre[config['embeddings_file']] for config, _, _, _, _ in missing]
+                                                if args.warm_start else None,
+                                   epochs=args.warm_epochs if args.warm_start else None)
+    else:
+        models = []
+
+    for model, (config, key, cstats, _, out_files) in zip(models, missing):
+        matrix_out_file = out_files[-1]
+
+        #Load pre-trained and table embeddings
+        vec_pre = kvs_pre[config['embeddings_file']].vectors
+        idx_pre = kvs_pre[config['embeddings_file']].key_to_index
+        kv_tab = model.wv
+        vec_tab = kv_tab.vectors
+        words_tab_set = set(kv_tab.key_to_index.keys())
+        idx_tab = kv_tab.key_to_index
+
+        #Find anchor words
+        with stage_timer(cstats, 'anchors'):
+            anchors = words_tab_set & worker['words_pre_sets'][config['embeddings_file']] #Common words are the intersection
+            pairs = [(idx_pre[w], idx_tab[w]) for w in anchors]
+        cstats['n_anchors'] = len(pairs)
+
+        #Align pre-trained vectors to the table embedding space, the table
+        #embeddings of a warm start are close to the pre-trained space already
+        init = np.eye(config['dimension']) if args.warm_start else None
+        with stage_timer(cstats, 'alignment'):
+            R = align_embeddings(vec_pre, vec_tab, pairs, init=init)
+
+        #Save alignment matrix
+        np.save(matrix_out_file, R)
+
+        if args.cache_dir:
+            copy_files(out_files, cache_files(args.cache_dir, key, args.output_format))
+
+    return [dict(stats, **cstats) for cstats in config_stats]
 
 
 if __name__ == '__main__':
     args = parse_args()
 
-    #Create output directory
-    try:
-        os.makedirs(args.output_dir)
-    except FileExistsError:
-        pass
+    #Create output directories
+    configs = build_configs(args)
+    for config in configs:
+        os.makedirs(config['output_dir'], exist_ok=True)
     #Create temporary directory for storing auxilary files
-    try:
-        os.makedirs(TEMP_DIR)
-    except FileExistsError:
-        pass
+    if args.write_temp:
+        try:
+            os.makedirs(TEMP_DIR)
+        except FileExistsError:
+            pass
 
     #Load the pre-trained word embeddings
     #NOTE: In our case the pre-trained embeddings are the source embeddings, while
     #      the table embeddings are the target embeddings, and we want to find
     #      a mapping from the table embeddings space to the pre-trained space
-    kv_pre = KeyedVectors.load_word2vec_format(args.embeddings_file)
-    vec_pre = kv_pre.vectors
-    words_pre_set = set(kv_pre.key_to_index.keys())
-    idx_pre = kv_pre.key_to_index
+    #The alignment maps each pre-trained file to the table embeddings of its
+    #dimension, so the dimensions must match
+    kvs_pre = {f: load_embeddings(f) for f in set(config['embeddings_file'] for config in configs)}
+    for config in configs:
+        if kvs_pre[config['embeddings_file']].vector_size != config['dimension']:
+            sys.exit(f"Dimension {config['dimension']} does not match the pre-trained embeddings "
+                     f"{config['embeddings_file']} ({kvs_pre[config['embeddings_file']].vector_size})")
+
+    #Load the record of the tables completed by previous runs, and rewrite it
+    #to drop any record that an interrupted run left incomplete
+    manifest_file = os.path.join(args.output_dir, MANIFEST_FILE)
+    manifest = load_manifest(manifest_file)
+    write_manifest(manifest_file, manifest)
+    params = manifest_params(configs)
 
     with open(args.tables_file, 'r') as f:
-        #Read a table
-        for line in tqdm(f.readlines()):
-            #Load table
-            table = json.loads(line)
-            table_id = table['id']
-            tdf = wikisql_table_to_df(table)
+        n_tables = sum(1 for _ in f)
+    pbar = tqdm(total=n_tables)
 
-            #File to save new table embeddings
-            emb_out_file = os.path.join(args.output_dir, f"{table_id}.emb")
-            #File to save alignment matrix
-            matrix_out_file = os.path.join(args.output_dir, f"{table_id}.R.npy")
+    def pending_tables():
+        #Skip the tables completed by previous runs
+        for line, table_id, digest in read_tables(args.tables_file):
+            if is_complete(manifest, table_id, digest, configs, args.output_format):
+                pbar.update(1)
+            else:
+                yield line, table_id, digest
 
-            #Create table embeddings
-            model = create_table_emb(tdf, emb_out_file, args.embeddings_algorithm, args.embeddings_dimension, TEMP_DIR)
+    #The tables that are embedded concurrently take their threads from a
+    #common budget, a large table may use the whole machine while small ones
+    #get a thread each
+    cpu_budget = CPUBudget(mp.cpu_count())
 
-            #Load table embeddings
-            kv_tab = model.wv
-            vec_tab = kv_tab.vectors
-            words_tab_set = set(kv_tab.key_to_index.keys())
-            idx_tab = kv_tab.key_to_index
+    failures = []
 
-            #Find anchor words
-            anchors = words_tab_set & words_pre_set #Common words are the intersection
-            pairs = [(idx_pre[w], idx_tab[w]) for w in anchors]
+    def collect(table_id, digest, get_result):
+        #Record a table as completed after its output files are written
+        try:
+            table_stats = get_result()
+            append_manifest(manifest_file, {'id': table_id, 'input': digest, 'params': params})
+        except Exception:
+            failures.append((table_id, traceback.format_exc()))
+        else:
+            if args.stats_file:
+                with open(args.stats_file, 'a') as f:
+                    for stats in table_stats:
+                        f.write(json.dumps(stats) + '\n')
+        pbar.update(1)
 
-            #Align pre-trained vectors to the table embedding space
-            R = align_embeddings(vec_pre, vec_tab, pairs)
+    if args.workers > 1:
+        #The pool processes are forked, so they share the pre-trained
+        #embeddings with the parent instead of receiving a pickled copy
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=mp.get_context('fork'),
+                                 initializer=init_worker, initargs=(args, kvs_pre, cpu_budget)) as executor:
+            #Keep only a few tables per worker in flight, so that the tables
+            #file is never loaded in memory as a whole
+            pending = {}
+            for line, table_id, digest in pending_tables():
+                if len(pending) >= 2 * args.workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(*pending.pop(future), future.result)
+                pending[executor.submit(embed_table, line)] = (table_id, digest)
+            for future in as_completed(pending):
+                collect(*pending[future], future.result)
+    else:
+        init_worker(args, kvs_pre, cpu_budget)
+        for line, table_id, digest in pending_tables():
+            collect(table_id, digest, lambda: embed_table(line))
+    pbar.close()
 
-            #Save alignment matrix
-            np.save(matrix_out_file, R)
+    #Report the tables that could not be embedded
+    for table_id, error in failures:
+        print(f"Table {table_id} failed:\n{error}", file=sys.stderr)
+    if failures:
+        print(f"{len(failures)}/{n_tables} tables failed", file=sys.stderr)
+        sys.exit(1)
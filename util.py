@@ -1,58 +1,367 @@
+import hashlib
+import json
+import multiprocessing as mp
+import random
+import resource
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
 import pandas as pd
+from gensim.models import KeyedVectors
 
 from EmbDI.edgelist import EdgeList
 from EmbDI.utils import *
 from EmbDI.graph import graph_generation
+from EmbDI.csr_graph import CSRGraph
 from EmbDI.sentence_generation_strategies import random_walks_generation
-from EmbDI.embeddings import learn_embeddings
+from EmbDI.embeddings import learn_embeddings, embeddings_files, read_embeddings, OUTPUT_FORMATS
+
+# Default parameters
+CONFIGURATION = {
+    'walks_strategy': 'basic',
+    # 'dict' builds a Node object per token, 'csr' stores the graph in integer arrays, which is smaller and faster
+    # to build for large tables
+    'graph_engine': 'dict',
+    'flatten': 'all',
+    'n_sentences': 'default',
+    'sentence_length': 10,
+    'intersection': False,
+    'backtrack': True,
+    'repl_numbers': False,
+    'repl_strings': False,
+    'follow_replacement': False,
+    'mlflow': False,
+    'window_size': 15,
+    'learning_method': 'skipgram',
+    'sampling_factor': 0.001,
+    # Optional budget of the walks corpus, unlimited if None: maximum number of words in the corpus, maximum
+    # seconds spent generating walks, and visits of every node after which the walks are not improving the coverage
+    'walks_token_budget': None,
+    'walks_time_budget': None,
+    'walks_min_occurrences': None,
+    # Replace the words of the graph with short keys while building the graph and the walks, which cuts the memory of
+    # large tables. The embeddings are saved with the original words. Only for word2vec, fasttext learns from the
+    # characters of the words.
+    'compression': False
+}
+
+#Parameters that the cached graph and random walks of a table depend on
+GRAPH_PARAMS = ['flatten', 'compression']
+WALKS_PARAMS = ['walks_strategy', 'graph_engine', 'n_sentences', 'sentence_length', 'intersection', 'backtrack',
+                'repl_numbers', 'repl_strings', 'follow_replacement',
+                'walks_token_budget', 'walks_time_budget', 'walks_min_occurrences']
+
+#Words of the walks corpus per training thread, smaller corpora are trained
+#with fewer threads, since starting and synchronizing the threads would cost
+#more than the training itself
+WORDS_PER_THREAD = 50000
+
+def corpus_threads(n_words, max_threads):
+    """
+    Return the number of threads worth using for a corpus of n_words words,
+    one per WORDS_PER_THREAD words, between 1 and max_threads
+    """
+    return max(1, min(max_threads, -(-n_words // WORDS_PER_THREAD)))
 
-def create_table_emb(tdf, emb_file, emb_alg, emb_dim, temp_dir):
+
+class CPUBudget:
     """
-    Use EmbDI to create table embeddings for a WikISQL table
+    Pool of CPU threads shared by the processes that embed tables concurrently,
+    so that together they do not use more threads than the machine has. It
+    must be created before the processes are forked.
 
-        Parameters:
-            tdf : The Dataframe of a WikiSQL table
+    Every table asks for the threads its corpus is worth (see corpus_threads)
+    and gets as many of them as are free, or a single thread if none are free,
+    so that no table ever waits for the others.
     """
-    edge_file = os.path.join(temp_dir, "tmp.edgelist")
-    walks_file = os.path.join(temp_dir, "tmp.walks")
-    prefixes = ['3$__tn', '3$__tt', '5$__idx', '1$__cid']
-    info = None
+    def __init__(self, n_threads=mp.cpu_count()):
+        self.n_threads = n_threads
+        self.free = mp.Value('i', n_threads)
+
+    @contextmanager
+    def threads(self, n_words):
+        """
+        Take the threads for a corpus of n_words words from the pool for the
+        duration of the block, yields the number of threads taken
+        """
+        with self.free.get_lock():
+            taken = max(1, min(corpus_threads(n_words, self.n_threads), self.free.value))
+            self.free.value -= taken
+        try:
+            yield taken
+        finally:
+            with self.free.get_lock():
+                self.free.value += taken
+
+
+def count_words(walks):
+    #The walks are either a list of sentences or the path of the walks file
+    if isinstance(walks, str):
+        with open(walks, 'r') as f:
+            return sum(len(line.split()) for line in f)
+    return sum(len(sentence) for sentence in walks)
+
+
+def reset_peak_rss():
+    #Only Linux can reset the peak RSS of the process (VmHWM) to its current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
 
-    # Default parameters
-    configuration = {
-        'walks_strategy': 'basic',
-        'walks_file' : walks_file,
-        'flatten': 'all',
-        'input_file': edge_file,
-        'n_sentences': 'default',
-        'sentence_length': 10,
-        'write_walks': True,
-        'intersection': False,
-        'backtrack': True,
-        'repl_numbers': False,
-        'repl_strings': False,
-        'follow_replacement': False,
-        'mlflow': False
+def peak_rss_mb():
+    """
+    Return the peak RSS of the process in MB since the last reset_peak_rss,
+    or since the start of the process where it cannot be reset
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    #ru_maxrss is in bytes on macOS and in KB on other systems
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 ** 2 if sys.platform == 'darwin' else maxrss / 1024
+
+@contextmanager
+def stage_timer(stats, stage):
+    """
+    Measure a stage of the pipeline and record in stats[stage] its wall time
+    and CPU time in seconds (the CPU time includes all threads) and the peak
+    RSS of the process in MB during the stage. Stages that run concurrently in
+    threads of the same process share the peak.
+    """
+    reset_peak_rss()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    yield
+    stats[stage] = {
+        'wall_time': time.perf_counter() - wall_start,
+        'cpu_time': time.process_time() - cpu_start,
+        'peak_rss_mb': peak_rss_mb(),
     }
 
-    #Create edgelist
-    EdgeList(tdf, edge_file, prefixes, info, flatten=True)
-    prefixes, edgelist = read_edgelist(configuration['input_file'])
+def create_table_emb(tdf, emb_file, emb_alg, emb_dim, temp_dir=None, workers=mp.cpu_count(), write_files=False,
+                     seed=None, stats=None, configuration=None, cache_dir=None, cpu_budget=None, output_format='text',
+                     init_vectors=None, epochs=None):
+    """
+    Use EmbDI to create table embeddings for a WikISQL table
 
-    graph = graph_generation(configuration, edgelist, prefixes, dictionary=None)
-    if configuration['n_sentences'] == 'default':
-        #  Compute the number of sentences according to the rule of thumb.
-        configuration['n_sentences'] = graph.compute_n_sentences(int(configuration['sentence_length']))
-    random_walks_generation(configuration, graph)
+        Parameters:
+            tdf : The Dataframe of a WikiSQL table
+            temp_dir : Directory for the auxiliary edgelist and walks files,
+                       it must not be shared by concurrent calls
+            workers : Maximum number of threads used for training the
+                      embeddings, and of processes used for the walks of the
+                      batch strategy. The table gets one for every
+                      WORDS_PER_THREAD words of its walks.
+            write_files : Write the edgelist and the walks in temp_dir and
+                          train from the files, instead of keeping
+                          everything in memory
+            seed : Seed for the random walks and the training, if given the
+                   embeddings of a table only depend on its contents (exactly
+                   reproducible only with workers=1)
+            stats : Optional dictionary, filled in with the measurements of
+                    every stage (see stage_timer) and the sizes of the graph,
+                    the walks and the vocabulary
+            configuration : Optional dictionary of parameters that override
+                            the defaults in CONFIGURATION
+            cache_dir : Optional directory to cache the graph and the random
+                        walks of the table, so that building the same table
+                        with other training parameters skips straight to
+                        training. Not used with write_files.
+            cpu_budget : Optional CPUBudget shared with the tables built
+                         concurrently, to take the threads from. It
+                         replaces workers.
+            output_format : Format of emb_file, one of OUTPUT_FORMATS. The
+                            binary formats 'gensim' and 'npy' are much
+                            faster to write and read than 'text', and
+                            'none' only returns the model.
+            init_vectors : Optional KeyedVectors with the dimension of the
+                           embeddings, e.g. the pre-trained embeddings, to
+                           warm start the training from. The words of the
+                           table found in them start from their vectors.
+            epochs : Number of training epochs, the gensim default if None.
+                     A warm start needs fewer of them.
+
+        Returns the trained model, its table embeddings are in model.wv
+    """
+    if stats is None:
+        stats = {}
+    if init_vectors is not None:
+        init_vectors = [init_vectors]
+    models = create_table_embs(tdf, [(emb_file, emb_alg, emb_dim)], temp_dir, workers=workers,
+                               write_files=write_files, seed=seed, stats=stats, configuration=configuration,
+                               cache_dir=cache_dir, config_stats=[stats], cpu_budget=cpu_budget,
+                               output_format=output_format, init_vectors=init_vectors, epochs=epochs)
+    return models[0]
+
+def create_table_embs(tdf, emb_configs, temp_dir=None, workers=mp.cpu_count(), write_files=False,
+                      seed=None, stats=None, configuration=None, cache_dir=None, config_stats=None,
+                      cpu_budget=None, output_format='text', init_vectors=None, epochs=None):
+    """
+    Use EmbDI to create several table embeddings for a WikISQL table, which
+    are all trained from the same random walks. The parameters are the same
+    as create_table_emb, except for:
 
-    model = learn_embeddings(emb_file, walks_file, True, emb_dim, 15,
-                     training_algorithm=emb_alg,
-                     learning_method='skipgram', sampling_factor=0.001
-                    )
-    return model
+        Parameters:
+            emb_configs : List of (emb_file, emb_alg, emb_dim) tuples, one for
+                          every embeddings to train
+            workers : Maximum number of threads, shared between the
+                      configurations that are trained concurrently
+            stats : Optional dictionary, filled in with the measurements of
+                    the stages up to the random walks
+            config_stats : Optional list of dictionaries, one for every
+                           configuration, filled in with the measurements of
+                           its training and the size of its vocabulary
+            init_vectors : Optional list of KeyedVectors, one for every
+                           configuration, to warm start its training from
+
+        Returns the list of trained models, in the order of emb_configs
+    """
+    if stats is None:
+        stats = {}
+    if cpu_budget is None:
+        cpu_budget = CPUBudget(workers)
+
+    configuration = dict(CONFIGURATION, **(configuration or {}))
+    if configuration['compression'] and any(emb_alg == 'fasttext' for _, emb_alg, _ in emb_configs):
+        raise ValueError('Interned words cannot be used with fasttext, which learns from the characters of the words')
+    if configuration['compression'] and write_files:
+        raise ValueError('Interned words cannot be used with write_files, which writes the edgelist and walks with their words')
+
+    if write_files:
+        edge_file = os.path.join(temp_dir, "tmp.edgelist")
+        walks_file = os.path.join(temp_dir, "tmp.walks")
+    else:
+        edge_file = None
+        walks_file = None
+    prefixes = ['3$__tn', '3$__tt', '5$__idx', '1$__cid']
+    info = None
 
-def wikisql_table_to_df(table):
-    #We must remove all commas, otherwise EmbDI cannot read the edgefile
+    configuration = dict(configuration,
+                         walks_file=walks_file, input_file=edge_file, write_walks=write_files,
+                         walks_seed=seed)
+
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+
+    #Cached graph and walks of the table, by table contents and parameters
+    graph_cache = walks_cache = None
+    if cache_dir and not write_files:
+        graph_key = params_digest({'table': dataframe_digest(tdf),
+                                   'graph': {k: configuration[k] for k in GRAPH_PARAMS}})
+        walks_key = params_digest({'graph': graph_key, 'seed': seed,
+                                   'walks': {k: configuration[k] for k in WALKS_PARAMS}})
+        #Only the array-backed graphs are cached
+        if configuration['graph_engine'] == 'csr' or configuration['walks_strategy'] == 'batch':
+            graph_cache = cache_path(cache_dir, graph_key, '.graph.npz')
+        walks_cache = cache_path(cache_dir, walks_key, '.walks.npz')
+
+    #Dictionary of the interned words of the graph and walks
+    dictionary = None
+
+    if walks_cache and os.path.isfile(walks_cache):
+        #Train straight from the walks of an earlier build
+        with stage_timer(stats, 'walks'):
+            walks, sizes, dictionary = load_walks(walks_cache)
+        stats.update(sizes)
+        stats['walks_cached'] = True
+    else:
+        if graph_cache and os.path.isfile(graph_cache):
+            with stage_timer(stats, 'graph'):
+                graph, dictionary = load_graph(graph_cache)
+            n_edges = graph.n_edges
+        else:
+            #Create edgelist
+            with stage_timer(stats, 'edgelist'):
+                el = EdgeList(tdf, edge_file, prefixes, info, flatten=True)
+                if write_files:
+                    prefixes, edgelist = read_edgelist(configuration['input_file'])
+                else:
+                    edgelist = el.get_edge_table()
+                    if configuration['compression']:
+                        edgelist.names, dictionary = intern_node_names(edgelist.names)
+
+            #The graph is built from the interned names as they are, the
+            #dictionary goes along with the graph and the walks to decode the
+            #words of the embeddings
+            with stage_timer(stats, 'graph'):
+                graph = graph_generation(configuration, edgelist, prefixes)
+            n_edges = len(edgelist)
+            if graph_cache:
+                save_graph(graph_cache, graph, dictionary)
+
+        if configuration['n_sentences'] == 'default':
+            #  Compute the number of sentences according to the rule of thumb.
+            configuration['n_sentences'] = graph.compute_n_sentences(int(configuration['sentence_length']))
+        if configuration['walks_token_budget']:
+            #  Cap the number of sentences so that the corpus fits in the budget. Nodes may contain several words.
+            words_per_node = sum(len(n.split()) for n in graph.get_node_list()) / len(graph.get_node_list())
+            words_per_sentence = int(configuration['sentence_length']) * words_per_node
+            configuration['n_sentences'] = min(configuration['n_sentences'],
+                                               max(1, int(configuration['walks_token_budget'] // words_per_sentence)))
+
+        #Only the batch strategy spreads the walks over several processes
+        if configuration['walks_strategy'] == 'batch':
+            n_words = configuration['n_sentences'] * int(configuration['sentence_length'])
+        else:
+            n_words = 0
+        with stage_timer(stats, 'walks'), cpu_budget.threads(n_words) as threads:
+            #The walks record in the configuration the number of walks generated
+            #within the budget, so it is updated in place
+            configuration['walks_workers'] = threads
+            walks = random_walks_generation(configuration, graph)
+
+        sizes = {
+            'n_edges': n_edges,
+            'n_nodes': len(graph.get_node_list()),
+            'n_walks': configuration['n_sentences'],
+        }
+        stats.update(sizes)
+        if walks_cache:
+            save_walks(walks_cache, walks, dictionary, **sizes)
+
+    #Train the configurations concurrently, each one with its share of the
+    #threads that the corpus is worth
+    if config_stats is None:
+        config_stats = [{} for _ in emb_configs]
+    if init_vectors is None:
+        init_vectors = [None for _ in emb_configs]
+    n_words = count_words(walks)
+
+    def train(emb_config, train_stats, train_init_vectors):
+        emb_file, emb_alg, emb_dim = emb_config
+        with stage_timer(train_stats, 'training'):
+            model = learn_embeddings(emb_file, walks, write_files, emb_dim, configuration['window_size'],
+                             training_algorithm=emb_alg,
+                             learning_method=configuration['learning_method'], workers=threads,
+                             sampling_factor=configuration['sampling_factor'], seed=seed,
+                             dictionary=dictionary, output_format=output_format,
+                             init_vectors=train_init_vectors, epochs=epochs
+                            )
+        train_stats['n_words'] = model.corpus_total_words
+        train_stats['vocab_size'] = len(model.wv)
+        return model
+
+    with cpu_budget.threads(n_words * len(emb_configs)) as budget:
+        stats['threads'] = budget
+        concurrent = max(1, min(len(emb_configs), budget))
+        threads = max(1, budget // concurrent)
+        with ThreadPoolExecutor(max_workers=concurrent) as executor:
+            return list(executor.map(train, emb_configs, config_stats, init_vectors))
+
+def wikisql_table_to_df(table, strip_commas=True):
+    #Commas must be removed for the text edgelist, otherwise EmbDI cannot read
+    #the edgefile. The binary edgelist (.npz) keeps them.
+    if not strip_commas:
+        return pd.DataFrame(columns=table['header'], data=table['rows'])
     header = [h.replace(',','') for h in table['header']]
     df = pd.DataFrame(columns=header, data=table['rows'])
     df = df.replace(',','', regex=True)
@@ -71,6 +380,159 @@ def wikisql_redable(sql, table):
 
     return sql_readable
 
+def convert_embeddings(vec_file, store_file):
+    """
+    Convert pre-trained embeddings from the word2vec text (or binary) format to
+    a gensim store, where the vectors are kept as a float32 .npy matrix next to
+    the vocabulary index, so that they can be memory-mapped when loaded
+    """
+    kv = KeyedVectors.load_word2vec_format(vec_file, binary=vec_file.endswith('.bin'))
+    kv.vectors = kv.vectors.astype(np.float32)
+    kv.save(store_file, separately=['vectors'])
+
+def load_embeddings(emb_file):
+    """
+    Load pre-trained embeddings. A store created by convert_embeddings (.kv) is
+    memory-mapped read-only, so that it loads almost instantly and concurrent
+    processes share a single copy of the vectors. Any other file is parsed in
+    the word2vec format.
+    """
+    if emb_file.endswith('.kv'):
+        return KeyedVectors.load(emb_file, mmap='r')
+    return KeyedVectors.load_word2vec_format(emb_file, binary=emb_file.endswith('.bin'))
+
+def table_digest(table):
+    """
+    Return a hash of the contents of a WikiSQL table, which changes whenever
+    the table in the tables file changes
+    """
+    return hashlib.sha1(json.dumps(table, sort_keys=True).encode('utf-8')).hexdigest()
+
+def dataframe_digest(tdf):
+    """
+    Return a hash of the header and the cell values of a table DataFrame, which
+    is the same for tables with equal contents regardless of their id
+    """
+    h = hashlib.sha1(json.dumps([str(c) for c in tdf.columns]).encode('utf-8'))
+    h.update(pd.util.hash_pandas_object(tdf.astype(str), index=False).values.tobytes())
+    return h.hexdigest()
+
+def params_digest(params):
+    """
+    Return a hash of a JSON serializable dictionary of parameters
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+def load_manifest(manifest_file):
+    """
+    Load the manifest of completed tables as a dictionary from table ids to
+    their records. A truncated last line, left behind by an interrupted run,
+    is ignored.
+    """
+    manifest = {}
+    if not os.path.isfile(manifest_file):
+        return manifest
+
+    with open(manifest_file, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            manifest[record['id']] = record
+    return manifest
+
+def write_manifest(manifest_file, manifest):
+    """
+    Atomically replace the manifest file with the records of the given manifest
+    """
+    with atomic_file(manifest_file) as tmp, open(tmp, 'w') as f:
+        for record in manifest.values():
+            f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def append_manifest(manifest_file, record):
+    """
+    Add the record of a completed table to the manifest file. The record is
+    written with a single write and synced, so that a crash can leave at most
+    a truncated last line, which load_manifest ignores.
+    """
+    with open(manifest_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def cache_path(cache_dir, key, extension=''):
+    #Cached files are spread over subdirectories by the first characters of the key
+    return os.path.join(cache_dir, key[:2], key + extension)
+
+@contextmanager
+def atomic_file(path):
+    """
+    Yield a temporary path to write a file to, which is renamed to the given
+    path once it is written, so that concurrent readers never see a partially
+    written file
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    yield tmp
+    os.replace(tmp, path)
+
+def save_npz(npz_file, **arrays):
+    #Save arrays in an .npz file, see atomic_file
+    with atomic_file(npz_file) as tmp, open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+
+def save_graph(graph_file, graph, dictionary=None):
+    """
+    Save an array-backed EmbDI graph, with its alias tables and the
+    dictionary of its interned words, if any
+    """
+    arrays = graph.to_arrays()
+    if dictionary is not None:
+        arrays['dictionary'] = dictionary.astype(str)
+    save_npz(graph_file, **arrays)
+
+def load_graph(graph_file):
+    """
+    Load a graph saved by save_graph. Returns the graph and the dictionary of
+    its interned words, None if its words are not interned.
+    """
+    with np.load(graph_file) as data:
+        arrays = {k: data[k] for k in data.files}
+    dictionary = arrays.pop('dictionary', None)
+    if dictionary is not None:
+        dictionary = dictionary.astype(object)
+    return CSRGraph.from_arrays(arrays), dictionary
+
+def save_walks(walks_file, walks, dictionary=None, **sizes):
+    """
+    Save a corpus of random walks, given as lists of words, as integer word
+    ids and the list of words. The dictionary of interned words, if any, and
+    the sizes of the table graph are saved along.
+    """
+    words = {}
+    ids = np.fromiter((words.setdefault(w, len(words)) for walk in walks for w in walk), dtype=np.int32)
+    lengths = np.fromiter((len(walk) for walk in walks), dtype=np.int64, count=len(walks))
+    if dictionary is not None:
+        sizes['dictionary'] = dictionary.astype(str)
+    save_npz(walks_file, words=np.array(list(words), dtype=str), ids=ids, lengths=lengths,
+             **{k: np.array(v) for k, v in sizes.items()})
+
+def load_walks(walks_file):
+    """
+    Load a corpus saved by save_walks. Returns the list of walks, the sizes
+    and the dictionary saved along.
+    """
+    with np.load(walks_file) as data:
+        words = data['words'].astype(object)[data['ids']].tolist()
+        ends = np.cumsum(data['lengths']).tolist()
+        dictionary = data['dictionary'].astype(object) if 'dictionary' in data.files else None
+        sizes = {k: data[k].item() for k in data.files if k not in ['words', 'ids', 'lengths', 'dictionary']}
+    walks = [words[start:end] for start, end in zip([0] + ends[:-1], ends)]
+    return walks, sizes, dictionary
+
 def vector_align(x, R):
     x_new = np.dot(x, R.T)
     x_new /= np.linalg.norm(x, axis=1)[:, np.newaxis] + 1e-8